@@ -0,0 +1,439 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import subprocess
+import tempfile
+from datetime import datetime, timedelta, timezone
+from time import perf_counter
+
+# the bot reads its settings on import, point it at a throwaway database, keep the metrics port closed and log to stdout only
+database_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False).name
+os.environ['database_file'] = database_file
+os.environ['metrics_port'] = '0'
+os.environ['log_file'] = ''
+
+parser = argparse.ArgumentParser(description='Load test DisMine against an in-process fake panel.')
+parser.add_argument('--users', type=int, default=5000)
+parser.add_argument('--servers', type=int, default=3000)
+parser.add_argument('--nodes', type=int, default=4)
+parser.add_argument('--allocations', type=int, default=2000, help='allocations per node')
+parser.add_argument('--commands', type=int, default=2000, help='invocations per command phase')
+parser.add_argument('--concurrency', type=int, default=50)
+parser.add_argument('--slots', type=int, default=200)
+parser.add_argument('--hours', type=float, default=6, help='simulated billing time')
+parser.add_argument('--latency', type=float, default=0.02, help='mean panel latency in seconds')
+parser.add_argument('--error-rate', type=float, default=0.01)
+parser.add_argument('--pool', type=int, default=0, help='warm servers filled before the command phases')
+parser.add_argument('--seed', type=int, default=1)
+parser.add_argument('--output', default='bench_output.txt')
+parser.add_argument('--verbose', action='store_true', help='show the bot output')
+arguments = parser.parse_args()
+os.environ['server_slots'] = str(arguments.slots)
+# logs are written from a thread, without --verbose they are not produced at all
+os.environ['log_level'] = 'INFO' if arguments.verbose else 'CRITICAL'
+# the pool is owned by a panel user no discord user maps to
+os.environ['pool_user'] = str(arguments.users + 1)
+os.environ['pool_size'] = str(arguments.pool)
+
+import bot as dismine  # noqa: E402
+
+
+# # fake time
+class Clock:
+    # replaces time_seconds in the bot so a minute of billing passes without sleeping
+    def __init__(self):
+        self.now = datetime.now().timestamp()
+
+    def __call__(self):
+        return self.now
+
+
+# # fake panel
+class Response:
+    def __init__(self, status: int):
+        self.status = status
+        self.headers = {}
+
+
+class FakePanel:
+    page_size = 50
+
+    def __init__(self, users: int, servers: int, nodes: int, allocations: int, latency: float, error_rate: float):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = 0
+        self.users = {
+            index: {'id': index, 'username': str(discord_id(index)), 'email': f'{index}@gmail.com'}
+            for index in range(1, users + 1)
+        }
+        self.nodes = {
+            index: {
+                'id': index, 'name': f'node-{index}', 'maintenance_mode': False, 'memory': 3072 * allocations,
+                'memory_overallocate': 0, 'disk': 1024 * allocations, 'disk_overallocate': 0
+            }
+            for index in range(1, nodes + 1)
+        }
+        self.allocations = {}
+        for node_id in self.nodes:
+            for port in range(25565, 25565 + allocations):
+                allocation_id = len(self.allocations) + 1
+                self.allocations[allocation_id] = {
+                    'id': allocation_id, 'ip': '10.0.0.1', 'port': port, 'assigned': False, 'node': node_id
+                }
+        self.servers = {}
+        free = iter(list(self.allocations.values()))
+        for index in range(1, min(servers, users) + 1):
+            self.add_server(index, next(free))
+
+    def add_server(self, user_id: int, allocation: dict):
+        server_id = len(self.servers) + 1
+        allocation['assigned'] = True
+        self.servers[server_id] = {
+            'id': server_id, 'identifier': f'{server_id:08x}', 'name': f'server-{server_id}', 'user': user_id,
+            'node': allocation['node'],
+            'allocation': allocation['id'], 'suspended': True, 'status': 'suspended',
+            'limits': {'memory': 3072, 'disk': 1024, 'cpu': 400}
+        }
+        return self.servers[server_id]
+
+    async def call(self):
+        self.calls += 1
+        await asyncio.sleep(random.expovariate(1 / self.latency) if self.latency else 0)
+        return random.random() >= self.error_rate
+
+    def page(self, rows: list, page: int):
+        pages = max(1, -(-len(rows) // self.page_size))
+        data = rows[(page - 1) * self.page_size:page * self.page_size]
+        return {'data': [{'attributes': row} for row in data], 'meta': {'pagination': {'total_pages': pages}}}
+
+    async def get_users(self, page: int = 1):
+        if not await self.call():
+            raise ConnectionError('fake panel error')
+        return self.page(list(self.users.values()), page)
+
+    async def get_servers(self, page: int = 1):
+        if not await self.call():
+            raise ConnectionError('fake panel error')
+        return self.page(list(self.servers.values()), page)
+
+    async def get_nodes(self, page: int = 1):
+        if not await self.call():
+            raise ConnectionError('fake panel error')
+        return self.page(list(self.nodes.values()), page)
+
+    async def get_node_allocations(self, node_id: int, page: int = 1):
+        if not await self.call():
+            raise ConnectionError('fake panel error')
+        rows = [
+            {key: value for key, value in allocation.items() if key != 'node'}
+            for allocation in self.allocations.values() if allocation['node'] == node_id
+        ]
+        return self.page(rows, page)
+
+    async def get_server(self, server_id: int):
+        if not await self.call():
+            raise ConnectionError('fake panel error')
+        server = self.servers[server_id]
+        # the egg install is done by the time anyone checks
+        if server['status'] == 'installing':
+            server['status'] = None
+        return {'attributes': server}
+
+    async def set_suspended(self, server_id: int, suspended: bool):
+        if not await self.call():
+            return Response(500)
+        if server_id not in self.servers:
+            return Response(404)
+        # like panel 1.7 and later, suspension shows in status as well
+        self.servers[server_id].update(suspended=suspended, status='suspended' if suspended else None)
+        return Response(204)
+
+    async def suspend_server(self, server_id: int):
+        return await self.set_suspended(server_id, True)
+
+    async def unsuspend_server(self, server_id: int):
+        return await self.set_suspended(server_id, False)
+
+    async def delete_server(self, server_id: int):
+        if not await self.call():
+            return Response(500)
+        return Response(204 if self.servers.pop(server_id, None) else 404)
+
+    async def delete_user(self, user_id: int):
+        if not await self.call():
+            return {'errors': [{'status': '500', 'detail': 'fake panel error'}]}
+        self.users.pop(user_id, None)
+        return {}
+
+    async def create_server(self, user_id: int, default_allocation: int, **kwargs):
+        if not await self.call():
+            return {'errors': [{'status': '500', 'detail': 'fake panel error'}]}
+        server = self.add_server(user_id, self.allocations[default_allocation])
+        server.update(suspended=False, status='installing')
+        return {'attributes': server}
+
+    async def update_server_details(self, server_id: int, name: str, user_id: int):
+        if not await self.call():
+            return {'errors': [{'status': '500', 'detail': 'fake panel error'}]}
+        self.servers[server_id].update(name=name, user=user_id)
+        return {'attributes': self.servers[server_id]}
+
+    async def create_user(self, email: str, first_name: str, last_name: str, username):
+        if not await self.call():
+            return {'errors': [{'status': '500', 'detail': 'fake panel error'}]}
+        user_id = len(self.users) + 1
+        self.users[user_id] = {'id': user_id, 'username': str(username), 'email': email}
+        return {'attributes': self.users[user_id]}
+
+
+# # fake discord
+def discord_id(index: int):
+    return 10 ** 17 + index
+
+
+class Message:
+    async def edit(self, **kwargs):
+        pass
+
+    async def delete(self):
+        pass
+
+
+class Author:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.created_at = datetime.now(timezone.utc) - timedelta(days=365)
+        self.display_name = str(user_id)
+        self.discriminator = '0000'
+        self.mention = f'<@{user_id}>'
+
+
+class Context:
+    def __init__(self, user_id: int):
+        self.author = Author(user_id)
+        self.message = type('message', (), {'guild': None})()
+        self.replies = []
+
+    async def send(self, content=None, **kwargs):
+        self.replies.append(content)
+        return Message()
+
+
+# # measurements
+def percentile(values: list, fraction: float):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def database_statements():
+    return sum(sample[2] for sample in dismine.database_latency.samples.values())
+
+
+async def probe_loop_lag(samples: list, interval: float = 0.005):
+    while True:
+        start_time = perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(perf_counter() - start_time - interval)
+
+
+async def run_phase(name: str, calls: list, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+    lag = []
+    probe = asyncio.ensure_future(probe_loop_lag(lag))
+    statements = database_statements()
+
+    async def run(call):
+        nonlocal errors
+        async with semaphore:
+            start_time = perf_counter()
+            try:
+                await call()
+            except Exception:
+                errors += 1
+            latencies.append(perf_counter() - start_time)
+
+    start_time = perf_counter()
+    await asyncio.gather(*(run(call) for call in calls))
+    elapsed = perf_counter() - start_time
+    probe.cancel()
+    return {
+        'phase': name,
+        'calls': len(calls),
+        'errors': errors,
+        'throughput': round(len(calls) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'statements_per_call': round((database_statements() - statements) / max(1, len(calls)), 2),
+        'loop_lag_p99_ms': round(percentile(lag, 0.99) * 1000, 2),
+        'loop_lag_max_ms': round(max(lag, default=0) * 1000, 2)
+    }
+
+
+async def simulate_billing(hours: float, clock: Clock):
+    # every tick is a simulated minute, nothing sleeps so hours of billing take seconds
+    ticks = int(hours * 60)
+    latencies = []
+    statements = database_statements()
+    start_time = perf_counter()
+    for _ in range(ticks):
+        clock.now += 60
+        tick_start = perf_counter()
+        await dismine.bill_servers.coro()
+        latencies.append(perf_counter() - tick_start)
+    elapsed = perf_counter() - start_time
+    return {
+        'phase': 'billing',
+        'calls': ticks,
+        'errors': 0,
+        'throughput': round(ticks / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'statements_per_call': round((database_statements() - statements) / max(1, ticks), 2),
+        'running': len(dismine.running_servers),
+        'queued': len(dismine.admission_queue)
+    }
+
+
+async def simulate_purge(clock: Clock):
+    # everyone not running a server has been inactive for longer than purge_days
+    clock.now += (float(os.environ.get('purge_days', 30)) + 1) * 86400
+    servers = len(dismine.panel_cache.servers)
+    statements = database_statements()
+    start_time = perf_counter()
+    await dismine.purge_servers.coro()
+    await dismine.refresh_cache()
+    return {
+        'phase': 'purge',
+        'calls': 1,
+        'errors': 0,
+        'p50_ms': round((perf_counter() - start_time) * 1000, 2),
+        'statements_per_call': database_statements() - statements,
+        'removed': servers - len(dismine.panel_cache.servers)
+    }
+
+
+async def fill_pool(clock: Clock, size: int):
+    # one server per tick, the last tick suspends the installed ones
+    start_time = perf_counter()
+    for _ in range(size + 1):
+        await dismine.refill_pool.coro()
+    # warm servers have to survive a refresh from the panel that is newer than the local patches
+    clock.now += 1
+    await dismine.refresh_cache()
+    return {
+        'phase': 'pool',
+        'calls': size + 1,
+        'errors': 0,
+        'p50_ms': round((perf_counter() - start_time) * 1000, 2),
+        'warm': len(dismine.warm_servers())
+    }
+
+
+# # benchmark
+async def main():
+    random.seed(arguments.seed)
+    clock = Clock()
+    dismine.time_seconds = clock
+    fake_panel = FakePanel(
+        arguments.users, arguments.servers, arguments.nodes, arguments.allocations, arguments.latency,
+        arguments.error_rate
+    )
+    dismine.app.application = fake_panel
+    direct_messages = []
+
+    def send_dm(user_id: int, content: str, priority: int = None):
+        direct_messages.append((user_id, content))
+
+    dismine.send_dm = send_dm
+
+    def seed(connection, rows):
+        connection.executemany(
+            'INSERT OR REPLACE INTO users (id, credits, premium, server_status, last_online, stop_server) '
+            'VALUES (?, ?, ?, ?, ?, ?);',
+            rows
+        )
+
+    await dismine.database.transaction(seed, [
+        (discord_id(index), random.randint(0, 300), random.random() < 0.1, index <= arguments.servers,
+         int(clock()), False)
+        for index in range(1, arguments.users + 1)
+    ])
+
+    results = []
+    start_time = perf_counter()
+    await dismine.refresh_cache()
+    results.append({
+        'phase': 'refresh_cache', 'calls': 1, 'p50_ms': round((perf_counter() - start_time) * 1000, 2),
+        'panel_calls': fake_panel.calls
+    })
+
+    if arguments.pool:
+        fake_panel.users[arguments.users + 1] = {'id': arguments.users + 1, 'username': 'pool', 'email': 'pool@gmail.com'}
+        await dismine.refresh_cache()
+        panel_calls = fake_panel.calls
+        results.append(await fill_pool(clock, arguments.pool))
+        results[-1]['panel_calls'] = fake_panel.calls - panel_calls
+
+    def commands(command, count: int):
+        user_ids = [discord_id(random.randint(1, arguments.users)) for _ in range(count)]
+        return [lambda user_id=user_id: command.callback(Context(user_id)) for user_id in user_ids]
+
+    for name in ('credits', 'daily', 'start', 'remaining', 'queue', 'stop'):
+        panel_calls = fake_panel.calls
+        results.append(await run_phase(name, commands(getattr(dismine, name), arguments.commands), arguments.concurrency))
+        results[-1]['panel_calls'] = fake_panel.calls - panel_calls
+    panel_calls = fake_panel.calls
+    results.append(await simulate_billing(arguments.hours, clock))
+    results[-1]['panel_calls'] = fake_panel.calls - panel_calls
+    panel_calls = fake_panel.calls
+    results.append(await simulate_purge(clock))
+    results[-1]['panel_calls'] = fake_panel.calls - panel_calls
+    return results, len(direct_messages), fake_panel.calls
+
+
+def commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+if __name__ == '__main__':
+    output = io.StringIO()
+    with contextlib.nullcontext() if arguments.verbose else contextlib.redirect_stdout(output):
+        loop = asyncio.new_event_loop()
+        try:
+            results, messages, panel_calls = loop.run_until_complete(main())
+            loop.run_until_complete(dismine.ledger.flush())
+            loop.run_until_complete(dismine.database.close())
+        finally:
+            loop.close()
+            for suffix in ('', '-wal', '-shm'):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(database_file + suffix)
+
+    print(f'{"phase":<14}{"calls":>8}{"errors":>8}{"ops/s":>10}{"p50 ms":>10}{"p99 ms":>10}{"stmt/op":>9}')
+    for result in results:
+        print(
+            f'{result["phase"]:<14}{result["calls"]:>8}{result.get("errors", 0):>8}'
+            f'{result.get("throughput", ""):>10}{result["p50_ms"]:>10}{result.get("p99_ms", ""):>10}'
+            f'{result.get("statements_per_call", ""):>9}'
+        )
+    print(f'{messages} direct messages, {panel_calls} panel calls')
+
+    # one json line per run so results can be compared across commits
+    with open(arguments.output, 'a') as file:
+        file.write(json.dumps({
+            'commit': commit(), 'time': datetime.now().isoformat(timespec='seconds'),
+            'arguments': vars(arguments), 'results': results
+        }) + '\n')
@@ -1,129 +1,1559 @@
+import ast
 import asyncio
+import atexit
+import contextvars
 import discord
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import logging
 import pydactyl
+import random
+import re
 import sqlite3
+import sys
+import threading
+import traceback
+from aiohttp import ClientError, ClientSession, ClientTimeout, web
+from collections import Counter as Tally, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from discord.ext import commands, tasks
 from dotenv import load_dotenv
+from logging.handlers import QueueHandler, RotatingFileHandler
 from os import getenv, listdir, path
-from time import time as time_seconds
+from queue import Empty, SimpleQueue
+from time import perf_counter, sleep, time as time_seconds
+from typing import Optional
 
-# # Setup .env
-if not path.exists('.env'):
-    with open('.env', 'w') as environment:
-        environment.write('bot_token=yourToken\npterodactyl_site=https://example.com\napi_key=yourApiKey')
-    quit(f'please configure the .env file')
+load_dotenv()
 
 
 # # bot class setup
 class DisMine(commands.AutoShardedBot):
     async def setup_hook(self):
-        print(f'{current_time()} - [INFO] loading cogs')
-        if path.exists(f'{bot_location}cogs'):
-            for file in listdir(f'{bot_location}cogs'):
-                if file.endswith('.py'):
-                    try:
-                        await bot.load_extension(f'cogs.{file[:-3]}')
-                    except Exception as e:
-                        print(f'{current_time()} - [ERROR] Loading cog: {file[:-3]} reason: {e}')
+        mark_phase('login')
+        watchdog.watch(threading.get_ident())
+        dispatcher.start()
+        flush_ledger.start()
+        flush_activity.start()
+        if leader:
+            compact_ledger.start()
+        await timed_phase('database', database.open())
+        # independent of each other, the gateway connects once all three are done
+        await asyncio.gather(
+            timed_phase('metrics', start_metrics_server()),
+            timed_phase('state', load_state()),
+            timed_phase('cogs', load_cogs())
+        )
+        mark_phase('setup')
+
+    async def close(self):
+        # running sessions are persisted and resumed on boot, only drain when asked to
+        if leader and running_servers and getenv('drain_on_shutdown', 'false').lower() == 'true':
+            await drain_sessions()
+        await dispatcher.flush(5)
+        await super().close()
+        # stop() lets a running flush finish, the rest is flushed below
+        flush_ledger.stop()
+        compact_ledger.cancel()
+        cluster_sync.cancel()
+        poll_resources.cancel()
+        refill_pool.cancel()
+        flush_activity.cancel()
+        watchdog.stop()
+        if client_session:
+            await client_session.close()
+        if ledger.schedule():
+            await ledger.flushing
+        await save_activity()
+        await database.close()
 
 
 # # variables setup
 # logic variables
 startup = True
-running_servers = []
+# startup phases in seconds, reported when the first shard is ready
+boot_started = perf_counter()
+startup_phases = {}
+last_phase = boot_started
+running_servers = {}
+starting = set()
+lazy_loads = {}
+# last activity per user not written to users.last_online yet
+activity = {}
+server_slots = int(getenv('server_slots', 4))
+# a server below idle_cpu percent cpu, or offline, for idle_minutes is suspended to free its slot
+idle_cpu = float(getenv('idle_cpu', 5))
+idle_minutes = float(getenv('idle_minutes', 10))
+client_session = None
+# panel user owning the warm pool of installed, suspended servers handed to new users
+pool_user = int(getenv('pool_user', 0))
+pool_size = int(getenv('pool_size', 0)) if pool_user else 0
+pool_taken = set()
 variables_synced = False
+# cluster variables, cluster.py starts one worker per shard range, cluster 0 leads and runs the global loops
+cluster_id = int(getenv('cluster_id', 0))
+shard_ids = [int(shard) for shard in getenv('shard_ids').split(',')] if getenv('shard_ids') else None
+clustered = shard_ids is not None
+leader = cluster_id == 0
+snapshot_version = 0
 # bot variables
-load_dotenv()
 bot_location = f'{path.dirname(path.abspath(__file__))}/'
 intents = discord.Intents.default()
 intents.message_content = True
-bot = DisMine(command_prefix='lc!', intents=intents, help_command=None)
-# api variables
-app = pydactyl.Application(url=getenv('pterodactyl_site'), api_key=getenv('api_key'))
-panel_users = {}  # asyncio.run(app.get_users())['data']
-panel_servers = {}  # asyncio.run(app.get_servers())['data']
-panel_allocations = {}  # asyncio.run(app.get_node_allocations(1))['data']
+bot = DisMine(
+    command_prefix='lc!', intents=intents, help_command=None,
+    shard_ids=shard_ids, shard_count=int(getenv('shard_count')) if clustered else None
+)
 
-# # db setup
-connection = sqlite3.connect('data.db')
-cursor = connection.cursor()
-cursor.execute(
-    """CREATE TABLE IF NOT EXISTS users (
-                                    id INTEGER NOT NULL PRIMARY KEY,
-                                    credits INTEGER,
-                                    premium BOOLEAN,
-                                    server_status BOOLEAN,
-                                    last_online INTEGER,
-                                    stop_server BOOLEAN
-                                );"""
+
+# # logging setup
+class CachedTimeFormatter(logging.Formatter):
+    # strftime runs once per second instead of once per record
+    pattern = '%d/%m/%Y %H:%M:%S'
+
+    def __init__(self):
+        super().__init__()
+        self.second = None
+        self.stamp = ''
+
+    def formatTime(self, record, datefmt=None):
+        second = int(record.created)
+        if second != self.second:
+            self.second = second
+            self.stamp = datetime.fromtimestamp(second).strftime(self.pattern)
+        return self.stamp
+
+    @staticmethod
+    def fields(record):
+        return {key: value for key, value in record.__dict__.items() if key not in record_attributes}
+
+
+class TextFormatter(CachedTimeFormatter):
+    def format(self, record):
+        fields = ''.join(f' {key}={value}' for key, value in self.fields(record).items())
+        return f'{self.formatTime(record)} - [{record.levelname}] {record.getMessage()}{fields}'
+
+
+class JsonFormatter(CachedTimeFormatter):
+    pattern = '%Y-%m-%dT%H:%M:%S'
+
+    def format(self, record):
+        return json.dumps({
+            'time': f'{self.formatTime(record)}.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'message': record.getMessage(),
+            **self.fields(record)
+        }, default=str)
+
+
+class ConsoleHandler(logging.Handler):
+    # stdout is looked up on every write so redirecting it keeps working
+    def write_batch(self, records: list):
+        sys.stdout.write(''.join(f'{self.format(record)}\n' for record in records))
+        sys.stdout.flush()
+
+
+class BatchFileHandler(RotatingFileHandler):
+    def write_batch(self, records: list):
+        text = ''.join(f'{self.format(record)}\n' for record in records)
+        if self.stream is None:
+            self.stream = self._open()
+        # a whole batch goes in one file, rotating first when it would not fit
+        if self.maxBytes and self.stream.tell() and self.stream.tell() + len(text) >= self.maxBytes:
+            self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+        self.stream.write(text)
+        self.stream.flush()
+
+
+class LogWriter(threading.Thread):
+    # drains the log queue on its own thread, the event loop only pays for a queue put per record
+    def __init__(self, handlers: list, batch_size: int, interval: float):
+        super().__init__(name='log-writer', daemon=True)
+        self.queue = SimpleQueue()
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self.interval = interval
+
+    def run(self):
+        running = True
+        while running:
+            records = [self.queue.get()]
+            deadline = perf_counter() + self.interval
+            try:
+                while len(records) < self.batch_size and records[-1] is not None:
+                    records.append(self.queue.get(timeout=max(0, deadline - perf_counter())))
+            except Empty:
+                pass
+            if records[-1] is None:
+                running = False
+                records.pop()
+            for handler in self.handlers if records else ():
+                try:
+                    handler.write_batch(records)
+                except Exception:
+                    handler.handleError(records[0])
+
+    def stop(self):
+        if self.is_alive():
+            self.queue.put(None)
+            self.join(5)
+
+
+class ContextFilter(logging.Filter):
+    # adds the fields of the running command and the cluster to every record
+    def filter(self, record):
+        for key, value in log_context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        if clustered:
+            record.cluster = cluster_id
+        return True
+
+
+record_attributes = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime'}
+log_context = contextvars.ContextVar('log_context', default={})
+log_handlers = [ConsoleHandler()]
+log_handlers[0].setFormatter(JsonFormatter() if getenv('log_format', 'text') == 'json' else TextFormatter())
+# every cluster worker rotates its own file, an empty log_file turns the file off
+log_file = getenv('log_file', f'dismine-{cluster_id}.log' if clustered else 'dismine.log')
+if log_file:
+    log_handlers.append(BatchFileHandler(
+        log_file, maxBytes=int(getenv('log_max_bytes', 10 * 1024 * 1024)), backupCount=int(getenv('log_backups', 5)),
+        delay=True
+    ))
+    log_handlers[1].setFormatter(JsonFormatter())
+log_writer = LogWriter(log_handlers, int(getenv('log_batch_size', 256)), float(getenv('log_interval', 0.5)))
+log = logging.getLogger('dismine')
+log.setLevel(getenv('log_level', 'INFO').upper())
+log.propagate = False
+log.addHandler(QueueHandler(log_writer.queue))
+log.handlers[0].addFilter(ContextFilter())
+log_writer.start()
+atexit.register(log_writer.stop)
+
+
+# # metrics setup
+class Metric:
+    # prometheus text format metric, samples are keyed by their label values
+    kind = 'untyped'
+
+    def __init__(self, name: str, description: str, labels: tuple = ()):
+        self.name = f'dismine_{name}'
+        self.description = description
+        self.labels = labels
+        self.samples = {}
+        metrics.append(self)
+
+    def label_text(self, values: tuple, extra: str = ''):
+        pairs = [f'{label}="{value}"' for label, value in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self):
+        yield f'# HELP {self.name} {self.description}'
+        yield f'# TYPE {self.name} {self.kind}'
+        for values, value in self.samples.items():
+            yield f'{self.name}{self.label_text(values)} {value}'
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *values, amount: float = 1):
+        self.samples[values] = self.samples.get(values, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name: str, description: str, labels: tuple = (), function=None):
+        super().__init__(name, description, labels)
+        # function returns {label values: value} and is read at scrape time
+        self.function = function
+
+    def set(self, value: float, *values):
+        self.samples[values] = value
+
+    def render(self):
+        if self.function:
+            self.samples = self.function()
+        yield from super().render()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def observe(self, value: float, *values):
+        sample = self.samples.get(values)
+        if sample is None:
+            sample = self.samples[values] = [[0] * len(self.buckets), 0, 0]
+        for index, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                sample[0][index] += 1
+        sample[1] += value
+        sample[2] += 1
+
+    def render(self):
+        yield f'# HELP {self.name} {self.description}'
+        yield f'# TYPE {self.name} {self.kind}'
+        for values, (counts, total, count) in self.samples.items():
+            for bucket, bucket_count in zip((*self.buckets, '+Inf'), (*counts, count)):
+                le = f'le="{bucket}"'
+                yield f'{self.name}_bucket{self.label_text(values, le)} {bucket_count}'
+            yield f'{self.name}_sum{self.label_text(values)} {total}'
+            yield f'{self.name}_count{self.label_text(values)} {count}'
+
+
+metrics = []
+command_latency = Histogram('command_seconds', 'Command run time.', ('command', 'status'))
+panel_latency = Histogram('panel_request_seconds', 'Panel API request time.', ('method', 'status'))
+database_latency = Histogram('database_seconds', 'Database call time including queueing.', ('operation',))
+panel_rate_limits = Counter('panel_rate_limited_total', 'Panel API 429 responses.', ('method',))
+cache_refresh_latency = Histogram('cache_refresh_seconds', 'Panel cache refresh time.')
+cache_size = Gauge('cache_rows', 'Rows in the panel cache.', ('family',))
+running_gauge = Gauge(
+    'running_servers', 'Servers currently running.', function=lambda: {(): len(running_servers)}
+)
+queued_gauge = Gauge(
+    'queued_users', 'Users waiting for a slot.', function=lambda: {(): len(admission_queue)}
 )
-connection.commit()
+online_gauge = Gauge(
+    'online_servers', 'Running sessions whose server is online and billed.',
+    function=lambda: {(): sum(session.online for session in running_servers.values())}
+)
+idle_suspensions = Counter('idle_suspensions_total', 'Servers suspended for being idle.')
+loop_lag = Histogram('loop_lag_seconds', 'How late the event loop heartbeat ran.')
+loop_stalls = Counter('loop_stalls_total', 'Times the event loop was blocked past the stall threshold.')
+startup_seconds = Gauge('startup_seconds', 'Wall time of each startup phase.', ('phase',))
+shard_latency = Gauge(
+    'gateway_latency_seconds', 'Gateway heartbeat latency per shard.', ('shard',),
+    function=lambda: {(shard_id,): latency for shard_id, latency in bot.latencies if latency == latency}
+)
+
+
+# # api setup
+class PanelClient:
+    # wraps pydactyl with a cap on in-flight requests, 429 back off, retries for reads and read coalescing
+    def __init__(self, factory, limit: int, retries: int):
+        # the pydactyl client is built on the first request, not on import
+        self.factory = factory
+        self.application = None
+        self.semaphore = asyncio.Semaphore(limit)
+        self.retries = retries
+        self.paused_until = 0
+        self.in_flight = {}
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        async def call(*args, **kwargs):
+            if not name.startswith('get_'):
+                return await self.request(name, args, kwargs, False)
+
+            # identical reads share one request
+            key = (name, args, tuple(sorted(kwargs.items())))
+            if key not in self.in_flight:
+                self.in_flight[key] = asyncio.ensure_future(self.request(name, args, kwargs, True))
+                self.in_flight[key].add_done_callback(lambda future: self.in_flight.pop(key, None))
+            return await asyncio.shield(self.in_flight[key])
+        return call
+
+    @staticmethod
+    def status(response):
+        if isinstance(response, dict):
+            errors = response.get('errors')
+            return int(errors[0].get('status', 500)) if errors else 200
+        return getattr(response, 'status', 200)
+
+    @staticmethod
+    def retry_after(response):
+        try:
+            return float(response.headers['Retry-After'])
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return None
+
+    async def request(self, name: str, args: tuple, kwargs: dict, idempotent: bool):
+        attempt = 0
+        while True:
+            # a 429 pauses every request, the rate limit is per api key not per call
+            while self.paused_until > time_seconds():
+                await asyncio.sleep(self.paused_until - time_seconds())
+
+            async with self.semaphore:
+                if self.application is None:
+                    self.application = self.factory()
+                start_time = perf_counter()
+                try:
+                    response = await getattr(self.application, name)(*args, **kwargs)
+                except Exception as e:
+                    panel_latency.observe(perf_counter() - start_time, name, 'exception')
+                    if not idempotent or attempt >= self.retries:
+                        raise
+                    log.warning(f'panel {name} failed, retrying | {e!r}')
+                    response = None
+
+            status = self.status(response) if response is not None else None
+            if status is not None:
+                panel_latency.observe(perf_counter() - start_time, name, status)
+            if status == 429 and attempt < self.retries:
+                delay = self.retry_after(response) or 2 ** attempt
+                self.paused_until = max(self.paused_until, time_seconds() + delay)
+                panel_rate_limits.inc(name)
+                log.warning(f'panel rate limited on {name}, waiting {delay} seconds')
+            elif (status is None or status >= 500) and idempotent and attempt < self.retries:
+                # full jitter so retries from concurrent commands spread out
+                await asyncio.sleep(random.uniform(0, min(30, 0.5 * 2 ** attempt)))
+            else:
+                return response
+            attempt += 1
+
+
+app = PanelClient(
+    lambda: pydactyl.Application(url=getenv('pterodactyl_site'), api_key=getenv('api_key')),
+    limit=int(getenv('panel_concurrency', 8)),
+    retries=int(getenv('panel_retries', 3))
+)
+
+
+# # db setup
+class Database:
+    # a single worker thread owns the sqlite connection so queries never block the event loop
+    def __init__(self, file: str):
+        self.file = file
+        self.connection = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='database')
+        self.opened = None
+
+    def open(self):
+        # connects on first use so importing the bot touches nothing, queries queue up behind the connect
+        if self.opened is None:
+            self.opened = asyncio.wrap_future(self.executor.submit(self.connect))
+        return self.opened
+
+    def connect(self):
+        # cluster workers share the file, wait for another process holding the write lock
+        self.connection = sqlite3.connect(self.file, timeout=30)
+        self.connection.execute('PRAGMA journal_mode=WAL;')
+        self.connection.execute('PRAGMA synchronous=NORMAL;')
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS users (
+                                            id INTEGER NOT NULL PRIMARY KEY,
+                                            credits INTEGER,
+                                            premium BOOLEAN,
+                                            server_status BOOLEAN,
+                                            last_online INTEGER,
+                                            stop_server BOOLEAN
+                                        );"""
+        )
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS sessions (
+                                            user_id INTEGER NOT NULL PRIMARY KEY,
+                                            server_id INTEGER NOT NULL,
+                                            started REAL NOT NULL,
+                                            billed REAL
+                                        );"""
+        )
+        # billed was added later, older sessions are billed from started until their next charge
+        if 'billed' not in {column[1] for column in self.connection.execute('PRAGMA table_info(sessions);')}:
+            self.connection.execute('ALTER TABLE sessions ADD COLUMN billed REAL;')
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS credit_events (
+                                            id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+                                            user_id INTEGER NOT NULL,
+                                            amount INTEGER NOT NULL,
+                                            reason TEXT NOT NULL,
+                                            created REAL NOT NULL
+                                        );"""
+        )
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS credit_events_user ON credit_events (user_id, id);'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS users_last_online ON users (last_online);')
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS ledger_state (
+                                            key TEXT NOT NULL PRIMARY KEY,
+                                            value INTEGER NOT NULL
+                                        );"""
+        )
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS panel_snapshot (
+                                            family TEXT NOT NULL PRIMARY KEY,
+                                            data TEXT NOT NULL
+                                        );"""
+        )
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS queue (
+                                            user_id INTEGER NOT NULL PRIMARY KEY,
+                                            premium BOOLEAN NOT NULL,
+                                            enqueued REAL NOT NULL,
+                                            position INTEGER NOT NULL,
+                                            minutes INTEGER NOT NULL
+                                        );"""
+        )
+        # shared between cluster workers, a claim holds a slot or allocation while a server is being started
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS slot_claims (
+                                            user_id INTEGER NOT NULL PRIMARY KEY,
+                                            claimed REAL NOT NULL
+                                        );"""
+        )
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS allocation_claims (
+                                            allocation_id INTEGER NOT NULL PRIMARY KEY,
+                                            claimed REAL NOT NULL
+                                        );"""
+        )
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS server_claims (
+                                            server_id INTEGER NOT NULL PRIMARY KEY,
+                                            claimed REAL NOT NULL
+                                        );"""
+        )
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS cluster_state (
+                                            key TEXT NOT NULL PRIMARY KEY,
+                                            value REAL NOT NULL
+                                        );"""
+        )
+        # last_online held the registration time until activity was tracked, count everyone as seen at that point
+        if not self.connection.execute("SELECT 1 FROM cluster_state WHERE key='activity_since';").fetchone():
+            now = int(time_seconds())
+            self.connection.execute(
+                'UPDATE users SET last_online = ? WHERE last_online IS NULL OR last_online < ?;', (now, now)
+            )
+            self.connection.execute("INSERT INTO cluster_state (key, value) VALUES ('activity_since', ?);", (now,))
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS command_tree (
+                                            hash TEXT NOT NULL PRIMARY KEY,
+                                            synced REAL NOT NULL
+                                        );"""
+        )
+        self.connection.commit()
+
+    async def run(self, function, *args):
+        self.open()
+        start_time = perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+        finally:
+            database_latency.observe(perf_counter() - start_time, function.__name__.strip('_'))
+
+    def _get(self, command: str, values: tuple):
+        return self.connection.execute(command, values).fetchone()
+
+    def _exec(self, command: str, values: tuple):
+        with self.connection:
+            self.connection.execute(command, values)
+
+    def _transaction(self, function, *args):
+        with self.connection:
+            return function(self.connection, *args)
+
+    def _all(self, command: str, values: tuple):
+        with self.connection:
+            return self.connection.execute(command, values).fetchall()
+
+    async def get(self, command: str, values: tuple):
+        return await self.run(self._get, command, values)
+
+    async def exec(self, command: str, values: tuple):
+        return await self.run(self._exec, command, values)
+
+    async def all(self, command: str, values: tuple):
+        return await self.run(self._all, command, values)
+
+    async def transaction(self, function, *args):
+        # runs function(connection, *args) on the database thread inside one transaction
+        return await self.run(self._transaction, function, *args)
+
+    async def close(self):
+        if self.opened is not None:
+            await self.run(self.connection.close)
+        self.executor.shutdown()
+
+
+database = Database(getenv('database_file', 'data.db'))
 
 
 # # functions
-def current_time():
-    return datetime.now().strftime('%d/%m/%Y %H:%M:%S')
+def mark_phase(phase: str):
+    # records the time since the previous mark as phase
+    global last_phase
+    now = perf_counter()
+    startup_phases[phase] = now - last_phase
+    last_phase = now
+
+
+async def timed_phase(phase: str, awaitable):
+    # for phases running concurrently, they don't move the mark
+    start_time = perf_counter()
+    try:
+        return await awaitable
+    finally:
+        startup_phases[phase] = perf_counter() - start_time
+
+
+def report_startup():
+    mark_phase('gateway')
+    for phase, seconds in startup_phases.items():
+        startup_seconds.set(round(seconds, 6), phase)
+    startup_seconds.set(round(last_phase - boot_started, 6), 'total')
+    log.info(
+        f'First shard ready after {last_phase - boot_started:.3f} seconds | '
+        f'{" ".join(f"{phase}={seconds:.3f}s" for phase, seconds in startup_phases.items())}'
+    )
+
+
+def lazy_commands(file: str):
+    # a cog that sets LAZY_COMMANDS = ('name', ...) is only imported once one of those commands is used,
+    # the file is parsed instead of imported to find out
+    try:
+        with open(file) as source:
+            tree = ast.parse(source.read())
+        for node in tree.body:
+            if isinstance(node, ast.Assign) and any(
+                isinstance(target, ast.Name) and target.id == 'LAZY_COMMANDS' for target in node.targets
+            ):
+                return tuple(ast.literal_eval(node.value))
+    except (OSError, SyntaxError, ValueError) as e:
+        log.error(f'Reading cog: {file} reason: {e}')
+    return ()
+
+
+async def load_cog(name: str):
+    start_time = perf_counter()
+    try:
+        await bot.load_extension(f'cogs.{name}')
+    except Exception as e:
+        return log.error(f'Loading cog: {name} reason: {e}')
+    log.info(f'Loaded cog {name} in {perf_counter() - start_time:.3f} seconds')
+
+
+async def load_cogs():
+    folder = f'{bot_location}cogs'
+    if not path.exists(folder):
+        return
+    eager = []
+    for file in listdir(folder):
+        if not file.endswith('.py'):
+            continue
+        names = lazy_commands(f'{folder}/{file}')
+        if names:
+            # prefix placeholders until the cog is loaded, lazy cogs have no slash commands in the synced tree
+            for name in names:
+                bot.add_command(commands.Command(run_lazy, name=name, extras={'lazy_cog': file[:-3]}))
+            log.info(f'Deferred cog {file[:-3]} until {", ".join(names)} is used')
+        else:
+            eager.append(file[:-3])
+    await asyncio.gather(*(load_cog(name) for name in eager))
+
+
+async def load_lazy(cog: str):
+    for command in [command for command in bot.commands if command.extras.get('lazy_cog') == cog]:
+        bot.remove_command(command.name)
+    await load_cog(cog)
+
+
+async def run_lazy(ctx):
+    # loads the cog once, then hands the context to the real command
+    cog = ctx.command.extras['lazy_cog']
+    if cog not in lazy_loads:
+        lazy_loads[cog] = asyncio.ensure_future(load_lazy(cog))
+    await asyncio.shield(lazy_loads[cog])
+    command = bot.get_command(ctx.command.qualified_name)
+    if command is None or command.extras.get('lazy_cog'):
+        return await ctx.send('This command is not available right now, please try again later.')
+    ctx.command = command
+    await command.invoke(ctx)
+
+
+async def db_get(command: str, values: tuple):
+    try:
+        output = await database.get(command, values)
+        return output
+    except Exception as e:
+        log.error(f'Database error | {e}')
+        return False
 
 
-def db_get(command: str, values: tuple):
+async def db_all(command: str, values: tuple):
     try:
-        output = cursor.execute(command, values).fetchone()
+        output = await database.all(command, values)
         return output
     except Exception as e:
-        print(f'{current_time()} - {e}')
+        log.error(f'Database error | {e}')
         return False
 
 
-def db_exec(command: str, values: tuple):
+async def db_exec(command: str, values: tuple):
     try:
-        cursor.execute(command, values)
-        connection.commit()
+        await database.exec(command, values)
         return True
     except Exception as e:
-        print(f'{current_time()} - {e}')
+        log.error(f'Database error | {e}')
         return False
 
 
-async def clear_queue():
-    server_count = 0
-    for server in panel_servers:
-        if not server['attributes']['suspended']:
-            if server['attributes']['id'] not in (1, 3):
-                output = await app.suspend_server(server['attributes']['id'])
-                if output.status == 204:
-                    server_count += 1
-                else:
-                    print(
-                        f'{current_time()} - [ERROR] suspending server: {server["attributes"]["id"]} | '
-                        f'code: {output.status}'
-                    )
-    print(f'{current_time()} - [INFO] Cleared queue stopped {server_count} servers from running')
+async def bulk_action(action: str, server_ids: list, limit: int = None, retries: int = 2):
+    # runs app.<action>(server_id) for every server with bounded parallelism, returns {server_id: status}
+    semaphore = asyncio.Semaphore(limit or int(getenv('bulk_concurrency', 16)))
+    results = {}
+    step = max(1, len(server_ids) // 10)
+
+    async def run(server_id):
+        async with semaphore:
+            for attempt in range(retries + 1):
+                try:
+                    status = PanelClient.status(await getattr(app, action)(server_id))
+                except Exception as e:
+                    log.warning(f'{action} {server_id} failed | {e!r}', extra={'server_id': server_id})
+                    status = None
+                if (status is not None and status < 500) or attempt == retries:
+                    break
+                await asyncio.sleep(random.uniform(0, 2 ** attempt))
+        results[server_id] = status
+        if len(results) % step == 0 or len(results) == len(server_ids):
+            log.info(f'{action} progress {len(results)}/{len(server_ids)}')
+
+    await asyncio.gather(*(run(server_id) for server_id in server_ids))
+    return results
+
+
+async def clear_queue(keep=()):
+    # suspends every running server except the protected ones and those in keep
+    server_ids = [
+        server.id for server in panel_cache.servers.values()
+        if not server.suspended and server.id not in (1, 3) and server.id not in keep and server.user != pool_user
+    ]
+    results = await bulk_action('suspend_server', server_ids)
+    for server_id, status in results.items():
+        if status != 204:
+            log.error(f'suspending server: {server_id} | code: {status}')
+    patch_suspended([server_id for server_id, status in results.items() if status == 204], True)
+    server_count = sum(status == 204 for status in results.values())
+    log.info(f'Cleared queue stopped {server_count} servers from running')
+    return server_count
+
+
+async def drain_sessions():
+    # suspend every running server before shutting down so nothing keeps running unbilled
+    sessions = list(running_servers.values())
+    running_servers.clear()
+    await remove_sessions(sessions)
+    results = await bulk_action('suspend_server', [session.server_id for session in sessions])
+    patch_suspended([server_id for server_id, status in results.items() if status == 204], True)
+    for session in sessions:
+        if results.get(session.server_id) != 204:
+            log.error(
+                f'Stopping server {session.server_id} | '
+                f'code: {results.get(session.server_id)}'
+            )
+    log.info(f'Drained {len(sessions)} running servers')
 
 
-async def credit_reduction(person, server, ctx):
-    # give person some time to start the server
-    await asyncio.sleep(60)
+def touch(user_id: int):
+    # activity is kept in memory and written in batches by flush_activity
+    now = int(time_seconds())
+    activity[user_id] = now
+    record = user_cache.get(user_id)
+    if record:
+        record.last_online = now
 
-    # while user has coins keep server alive
-    while person.get_credits() > 0:
-        person.update_credits(-1)
 
-        if person.get_credits() == 0 and not person.stop_server():
-            await ctx.author.send('You are running out of credits. Your server will stop in 60 seconds.')
+def write_activity(connection, rows: list):
+    # another cluster worker may have written a later time already
+    connection.executemany('UPDATE users SET last_online=MAX(COALESCE(last_online, 0), ?) WHERE id=?;', rows)
 
-        if person.stop_server():
-            await ctx.author.send('Your server will stop in 60 seconds.')
 
-        await asyncio.sleep(60)
+async def save_activity():
+    global activity
+    if not activity:
+        return
+    seen, activity = activity, {}
+    try:
+        await database.transaction(write_activity, [(last_online, user_id) for user_id, last_online in seen.items()])
+    except Exception as e:
+        # newer activity recorded meanwhile wins
+        for user_id, last_online in seen.items():
+            activity.setdefault(user_id, last_online)
+        log.error(f'Saving activity of {len(seen)} users | {e}')
+
+
+def reset_server_status(connection, user_ids: list):
+    connection.executemany(
+        'UPDATE users SET server_status=0 WHERE id=? AND server_status=1;', [(user_id,) for user_id in user_ids]
+    )
+
+
+def send_dm(user_id: int, content: str, priority: int = None):
+    dispatcher.send(user_id, content, priority)
+
+
+async def add_session(session):
+    running_servers[session.user_id] = session
+    await db_exec(
+        'INSERT OR REPLACE INTO sessions (user_id, server_id, started, billed) VALUES (?, ?, ?, ?);',
+        (session.user_id, session.server_id, session.started, session.billed)
+    )
+
+
+async def remove_sessions(sessions: list):
+    user_ids = tuple(session.user_id for session in sessions)
+    if user_ids:
+        await db_exec(f'DELETE FROM sessions WHERE user_id IN ({",".join("?" * len(user_ids))})', user_ids)
+
+
+async def stop_session(session, message: str = 'Your server has been stopped.'):
+    running_servers.pop(session.user_id, None)
+    await remove_sessions([session])
+    send_dm(session.user_id, f'{message} Thanks for using and supporting Nextpie ❤', priority_stop)
+    log.info(f'Stopping server {session.server_id}', extra={'server_id': session.server_id, 'user_id': session.user_id})
+    try:
+        output = await app.suspend_server(session.server_id)
+    except Exception as e:
+        # the session is gone either way, clear_queue suspends whatever is left running unbilled
+        return log.error(f'Stopping server {session.server_id} | {e!r}', extra={'server_id': session.server_id})
+    if output.status == 204:
+        patch_suspended([session.server_id], True)
+    else:
+        log.error(
+            f'Stopping server {session.server_id} | code: {output.status}', extra={'server_id': session.server_id}
+        )
+
+
+def write_snapshot(connection, families: dict, fetched: float):
+    connection.executemany(
+        'INSERT OR REPLACE INTO panel_snapshot (family, data) VALUES (?, ?);',
+        [(family, json.dumps(rows)) for family, rows in families.items()]
+    )
+    connection.execute("INSERT OR REPLACE INTO cluster_state (key, value) VALUES ('snapshot_fetched', ?);", (fetched,))
+    # cluster followers reload the snapshot when its version changes
+    connection.execute(
+        "INSERT INTO cluster_state (key, value) VALUES ('snapshot', 1) "
+        'ON CONFLICT (key) DO UPDATE SET value = value + 1;'
+    )
+    return connection.execute("SELECT value FROM cluster_state WHERE key='snapshot';").fetchone()[0]
+
+
+def read_state(connection, version: float = None):
+    # the snapshot is only read when its version differs from the one already loaded
+    state = dict(connection.execute('SELECT key, value FROM cluster_state;').fetchall())
+    snapshot = None
+    if version is None or state.get('snapshot', 0) != version:
+        snapshot = {family: json.loads(data) for family, data in connection.execute('SELECT * FROM panel_snapshot;')}
+    sessions = connection.execute('SELECT user_id, server_id, started, billed FROM sessions;').fetchall()
+    queue = connection.execute('SELECT user_id, premium, position, minutes FROM queue ORDER BY enqueued;').fetchall()
+    return state, snapshot, sessions, queue
+
+
+def snapshot_families(snapshot: dict):
+    families = {}
+    for family, record, _ in panel_families:
+        rows = snapshot.get(family, ())
+        # a snapshot written by an older release with other fields is refetched instead
+        if all(len(row) == len(record.__slots__) for row in rows):
+            families[family] = {row[0]: dict(zip(record.__slots__, row)) for row in rows}
+    return families
+
+
+async def save_snapshot(fetched: float):
+    # records are flattened on the loop, json encoding happens on the database thread
+    global snapshot_version
+    families = {}
+    for family, record, index in panel_families:
+        families[family] = [
+            [getattr(item, field) for field in record.__slots__] for item in getattr(panel_cache, index).values()
+        ]
+    try:
+        snapshot_version = await database.transaction(write_snapshot, families, fetched)
+    except Exception as e:
+        log.error(f'Saving panel snapshot | {e}')
+
+
+async def load_state():
+    global panel_cache, variables_synced, snapshot_version
+    start_time = perf_counter()
+    try:
+        state, snapshot, sessions, queue = await database.transaction(read_state)
+    except Exception as e:
+        log.error(f'Loading persisted state | {e}')
+        return
+
+    families = snapshot_families(snapshot)
+    panel_cache, _ = panel_cache.apply(**families)
+    snapshot_version = state.get('snapshot', 0)
+    for user_id, server_id, started, billed in sessions:
+        running_servers[user_id] = Session(user_id, server_id, started, billed)
+    admission_queue.load(queue)
+
+    # commands can run against the snapshot straight away, reconcile() catches up with the panel
+    variables_synced = bool(snapshot)
+    log.info(
+        f'Loaded snapshot ({sum(len(family) for family in families.values())} rows), '
+        f'{len(sessions)} sessions and {len(queue)} queued users in {perf_counter() - start_time:.3f} seconds'
+    )
+
+
+async def sync_cluster():
+    # mirrors what other cluster workers wrote, followers also pick up the panel snapshot of the leader
+    global panel_cache, variables_synced, snapshot_version
+    read_at = time_seconds()
+    try:
+        state, snapshot, sessions, queue = await database.transaction(read_state, snapshot_version)
+    except Exception as e:
+        return log.error(f'Syncing cluster state | {e}')
+
+    if snapshot is not None:
+        families = snapshot_families(snapshot)
+        keep_patched(families, state.get('snapshot_fetched', 0))
+        panel_cache, _ = panel_cache.apply(**families)
+        snapshot_version = state.get('snapshot', 0)
+        variables_synced = variables_synced or bool(snapshot)
+
+    current = {}
+    for user_id, server_id, started, billed in sessions:
+        session = running_servers.get(user_id)
+        if session is None or session.server_id != server_id:
+            session = Session(user_id, server_id, started, billed)
+        current[user_id] = session
+    for user_id, session in running_servers.items():
+        # added here after the read started, the row is written but was not read yet
+        if user_id not in current and session.started >= read_at:
+            current[user_id] = session
+    running_servers.clear()
+    running_servers.update(current)
+
+    admission_queue.load(queue)
+    if not leader:
+        admission_queue.next_estimate = int(state.get('queue_estimate', 0))
+
+
+def claim_slot_row(connection, user_id: int, slots: int, now: float):
+    # the delete takes the write lock first, so counting and inserting can't interleave with another worker
+    connection.execute('DELETE FROM slot_claims WHERE claimed < ?;', (now - 300,))
+    return connection.execute(
+        'INSERT OR IGNORE INTO slot_claims (user_id, claimed) SELECT ?, ? '
+        'WHERE (SELECT COUNT(*) FROM sessions) + (SELECT COUNT(*) FROM slot_claims) < ?;',
+        (user_id, now, slots)
+    ).rowcount == 1
+
+
+def claim_allocation_row(connection, allocation_id: int, now: float):
+    # claims outlive the next panel refresh, by then the allocation shows up as assigned
+    connection.execute('DELETE FROM allocation_claims WHERE claimed < ?;', (now - 600,))
+    return connection.execute(
+        'INSERT OR IGNORE INTO allocation_claims (allocation_id, claimed) VALUES (?, ?);', (allocation_id, now)
+    ).rowcount == 1
+
+
+def claim_server_row(connection, server_id: int, now: float):
+    connection.execute('DELETE FROM server_claims WHERE claimed < ?;', (now - 600,))
+    return connection.execute(
+        'INSERT OR IGNORE INTO server_claims (server_id, claimed) VALUES (?, ?);', (server_id, now)
+    ).rowcount == 1
+
+
+def write_tree_row(connection, tree_hash: str, now: float):
+    # one row, the hash of the last tree discord accepted
+    connection.execute('DELETE FROM command_tree;')
+    connection.execute('INSERT INTO command_tree (hash, synced) VALUES (?, ?);', (tree_hash, now))
+
+
+def command_tree_hash():
+    # what discord receives for every command plus its checks, key order and command order don't matter
+    payload = []
+    for command in bot.tree.get_commands():
+        data = command.to_dict(bot.tree)
+        # hybrid commands keep their checks on the prefix command they wrap
+        checks = getattr(getattr(command, 'wrapped', command), 'checks', ())
+        data['checks'] = sorted(check.__qualname__ for check in checks)
+        payload.append(data)
+    payload.sort(key=lambda data: (data.get('type', 1), data['name']))
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+async def sync_commands():
+    # only the leader syncs and only when the tree changed since the last synced deploy
+    tree_hash = command_tree_hash()
+    try:
+        synced_hash = await database.get('SELECT hash FROM command_tree WHERE hash = ?;', (tree_hash,))
+    except Exception as e:
+        return log.error(f'Checking command tree | {e}')
+    if synced_hash:
+        return log.info(f'Command tree unchanged ({tree_hash[:12]}), skipping sync')
+    start_time = perf_counter()
+    try:
+        synced = await bot.tree.sync()
+    except Exception as e:
+        # nothing is recorded, so the next boot retries whatever went wrong
+        return log.error(f'Syncing command tree | {e!r}')
+    # recorded only once discord accepted the tree, a crash before this line syncs again on the next boot
+    try:
+        await database.transaction(write_tree_row, tree_hash, time_seconds())
+    except Exception as e:
+        log.error(f'Recording command tree | {e}')
+    log.info(f'Synced {len(synced)} commands ({tree_hash[:12]}) in {perf_counter() - start_time:.3f} seconds')
+
+
+async def claim_slot(user_id: int):
+    # holds a slot in starting until launch() is done, in a cluster the slot is claimed in the shared database
+    if clustered:
+        try:
+            claimed = await database.transaction(claim_slot_row, user_id, server_slots, time_seconds())
+        except Exception as e:
+            log.error(f'Claiming a slot for {user_id} | {e}')
+            return False
+    else:
+        claimed = len(running_servers) + len(starting) < server_slots
+    if claimed:
+        starting.add(user_id)
+    return claimed
+
+
+async def release_slot(user_id: int):
+    starting.discard(user_id)
+    if clustered:
+        await db_exec('DELETE FROM slot_claims WHERE user_id=?', (user_id,))
+
+
+async def reserve_allocation():
+    # place() reserves locally, in a cluster the allocation is claimed as well so two workers never share one
+    while True:
+        allocation = panel_cache.place(placement_strategy)
+        if allocation is None or not clustered:
+            return allocation
+        try:
+            if await database.transaction(claim_allocation_row, allocation.id, time_seconds()):
+                return allocation
+        except Exception as e:
+            panel_cache.release_allocation(allocation)
+            log.error(f'Claiming allocation {allocation.id} | {e}')
+            return None
+        # another worker has it, it stays reserved here so place() moves on
+
+
+def patch_cache(**families):
+    # write-through after a panel mutation, rows are flattened attributes or None for a deleted entity
+    global panel_cache
+    panel_cache, _ = panel_cache.apply(**families, partial=True)
+    now = time_seconds()
+    for family, rows in families.items():
+        for entity_id in rows:
+            panel_cache.patched[(family, entity_id)] = now
+
+
+def patch_suspended(server_ids, suspended: bool):
+    servers = {}
+    for server_id in server_ids:
+        server = panel_cache.servers.get(server_id)
+        if server is None:
+            continue
+        servers[server_id] = {**server.attributes(), 'suspended': suspended}
+        if server.installed():
+            servers[server_id]['status'] = 'suspended' if suspended else None
+    patch_cache(servers=servers)
+
+
+def keep_patched(families: dict, fetched: float):
+    # a listing fetched before a patch is older than the patch, the patched entities keep their cached state
+    for (family, entity_id), patched in list(panel_cache.patched.items()):
+        if patched < fetched:
+            del panel_cache.patched[(family, entity_id)]
+            continue
+        if family not in families:
+            continue
+        index = next(index for name, _, index in panel_families if name == family)
+        record = getattr(panel_cache, index).get(entity_id)
+        if record is None:
+            families[family].pop(entity_id, None)
+        else:
+            families[family][entity_id] = record.attributes()
+
+
+async def refresh_server(server_id: int):
+    # single entity refresh, returns the cached server or None when it is gone
+    response = await app.get_server(server_id)
+    status = PanelClient.status(response)
+    if status == 404:
+        patch_cache(servers={server_id: None})
+    elif status == 200:
+        patch_cache(servers={server_id: PanelServer.flatten(response['attributes'])})
+    else:
+        log.error(f'Refreshing server {server_id} | code: {status}')
+    return panel_cache.servers.get(server_id)
+
+
+async def join_queue(person):
+    admission_queue.push(person.user_id, person.premium)
+    # premium users skip ahead, the row has to hold the recomputed position since followers answer /queue from it
+    update_queue_estimates()
+    position, minutes = admission_queue.estimate(person.user_id)
+    await db_exec(
+        'INSERT OR REPLACE INTO queue (user_id, premium, enqueued, position, minutes) VALUES (?, ?, ?, ?, ?);',
+        (person.user_id, person.premium, time_seconds(), position, minutes)
+    )
+
+
+async def leave_queue(user_ids: list):
+    for user_id in user_ids:
+        admission_queue.remove(user_id)
+    if user_ids:
+        await db_exec(f'DELETE FROM queue WHERE user_id IN ({",".join("?" * len(user_ids))})', tuple(user_ids))
+
+
+def write_estimates(connection, estimates: list, next_estimate: int):
+    connection.executemany('UPDATE queue SET position=?, minutes=? WHERE user_id=?;', estimates)
+    connection.execute(
+        "INSERT OR REPLACE INTO cluster_state (key, value) VALUES ('queue_estimate', ?);", (next_estimate,)
+    )
+
+
+async def reconcile():
+    global variables_synced
+    await refresh_cache()
+    if clustered:
+        await sync_cluster()
+
+    # sessions whose server is gone or suspended ended while we were down
+    ended = [
+        session for session in running_servers.values()
+        if session.server_id not in panel_cache.servers or panel_cache.servers[session.server_id].suspended
+    ]
+    for session in ended:
+        running_servers.pop(session.user_id, None)
+    await remove_sessions(ended)
+
+    # anything else running is not billed by anyone
+    stopped = await clear_queue(keep={session.server_id for session in running_servers.values()})
+    log.info(
+        f'Reconciled state resumed {len(running_servers)} sessions, '
+        f'dropped {len(ended)} and stopped {stopped} unbilled servers'
+    )
+    variables_synced = True
+    update_cache.start()
+    # billing waits for the sessions that ended while we were down to be dropped
+    bill_servers.start()
+
+
+async def launch(person):
+    # starts or creates the server of person, the slot taken by claim_slot() is held until the session exists
+    try:
+        return await _launch(person)
+    finally:
+        await release_slot(person.user_id)
+
+
+async def _launch(person):
+    user = panel_cache.users.get(str(person.user_id))
+    if user is None:
+        return 'Cannot find your account, use `/register` to create one.'
+
+    # check if user has server
+    servers = panel_cache.user_servers.get(user.id)
+    if servers:
+        server = servers[0]
+        # the cache is written through on every mutation, only a server it says is running is looked up
+        if not server.suspended:
+            server = await refresh_server(server.id) or server
+        if server.suspended:
+            output = await app.unsuspend_server(server.id)
+            if output.status == 204:
+                patch_suspended([server.id], False)
+                log.info(f'Starting server {server.id}', extra={'server_id': server.id})
+                await add_session(Session(person.user_id, server.id))
+                return (
+                    'Setting up your server visit https://panel.nextpie.nl to start it. '
+                    '(You get an extra minute to start your server)'
+                )
+            elif output.status == 500:
+                return 'Something went wrong starting your server, please try again.'
+            else:
+                log.error(f'starting server {server.id} | code: {output.status}', extra={'server_id': server.id})
+                return 'Something unusual went wrong starting your server, please try again.'
+        else:
+            return 'Server already active, you may need to manually start it on https://panel.nextpie.nl'
+
+    if person.has_server():
+        return 'Server already active, you may need to manually start it on https://panel.nextpie.nl'
+
+    # user has no server, an installed one from the pool only needs an unsuspend
+    server = await take_warm_server(user)
+    if server:
+        await person.set_server_status(True)
+        return await _launch(person)
+
+    # otherwise create one
+    allocation = await reserve_allocation()
+    if allocation is None:
+        log.error('No node has room or allocations left for a new server')
+        return 'Something went wrong... Go to the support server for help.'
+
+    server = await create_paper_server(user.id, allocation)
+    if 'errors' in server:
+        panel_cache.release_allocation(allocation)
+        log.error(f'Creating server for {person.user_id} | {server["errors"][0]["detail"]}')
+        return 'Something went wrong creating your server, please try again.'
+    log.info(f'Starting server {server["attributes"]["id"]}', extra={'server_id': server['attributes']['id']})
+    # the allocation stays reserved until a refresh reports it assigned
+    patch_cache(servers={server['attributes']['id']: PanelServer.flatten(server['attributes'])})
+
+    # set required variables, billing picks the session up on its next tick
+    await add_session(Session(person.user_id, server['attributes']['id']))
+    await person.set_server_status(True)
+    return (
+        'Creating your server visit https://panel.nextpie.nl to configure it. '
+        'You will be prompted to accept the Minecraft EULA.'
+    )
+
+
+async def create_paper_server(user_id: int, allocation):
+    # Paper MC server
+    return await app.create_server(
+        name="DisMine - MC paper",
+        user_id=user_id,
+        nest_id=1,
+        egg_id=2,
+        docker_image="ghcr.io/pterodactyl/yolks:java_17",
+        startup="java -Xms128M -XX:MaxRAMPercentage=95.0 -Dterminal.jline=false -Dterminal.ansi=true -jar {{SERVER_JARFILE}}",
+        environment={
+            "SERVER_JARFILE": "server.jar",
+            "MINECRAFT_VERSION": "latest",
+            "BUILD_NUMBER": "latest",
+        },
+        default_allocation=allocation.id
+    )
+
+
+def warm_servers():
+    # installed and suspended pool servers nobody is taking yet
+    return [
+        server for server in panel_cache.user_servers.get(pool_user, ())
+        if server.suspended and server.installed() and server.id not in pool_taken
+    ]
+
+
+async def take_warm_server(user):
+    # hands a pool server over to user by changing its owner, None when the pool is empty
+    for server in warm_servers():
+        if server.id in pool_taken:
+            continue
+        pool_taken.add(server.id)
+        try:
+            if clustered and not await database.transaction(claim_server_row, server.id, time_seconds()):
+                continue
+            response = await app.update_server_details(server.id, name=server.name, user_id=user.id)
+            if 'errors' in response:
+                log.error(f'Handing over server {server.id} | {response["errors"][0]["detail"]}')
+                continue
+            patch_cache(servers={server.id: PanelServer.flatten(response['attributes'])})
+            log.info(f'Handed warm server {server.id} to panel user {user.id}', extra={'server_id': server.id})
+            return panel_cache.servers[server.id]
+        except Exception as e:
+            log.error(f'Handing over server {server.id} | {e!r}')
+        finally:
+            pool_taken.discard(server.id)
+    return None
+
+
+def restart_loop(loop):
+    # called from the error handler while the failed task is still finishing, starts it again once it is done
+    def restart(task):
+        if not task.cancelled():
+            # already logged by the error handler
+            task.exception()
+            loop.start()
+    loop.get_task().add_done_callback(restart)
+
+
+async def admit_queue():
+    # fills free slots from the queue, called whenever a session ends
+    admitted = []
+    while admission_queue and await claim_slot(admission_queue.peek()):
+        user_id = admission_queue.pop()
+        admitted.append(user_id)
+        person = await Person.get(user_id)
+        if person.get_credits() < 1:
+            await release_slot(user_id)
+            send_dm(user_id, 'Your turn in the queue came up but you don\'t have enough credits.')
+            continue
+        try:
+            message = await launch(person)
+        except Exception as e:
+            log.error(f'Starting queued server of {user_id} | {e!r}', extra={'user_id': user_id})
+            message = 'Something went wrong starting your server, please try again.'
+        send_dm(user_id, message)
+    await leave_queue(admitted)
+    update_queue_estimates()
+    if clustered:
+        # followers answer /queue from these
+        try:
+            await database.transaction(
+                write_estimates,
+                [(position, minutes, user_id) for user_id, (position, minutes) in admission_queue.estimates.items()],
+                admission_queue.next_estimate
+            )
+        except Exception as e:
+            log.error(f'Saving queue estimates | {e}')
+
+
+def update_queue_estimates():
+    # min-heap of minutes until each slot frees up, queued users are walked through it in order
+    slots = []
+    for user_id in (*running_servers, *starting):
+        record = user_cache.get(user_id)
+        if record is None:
+            slots.append(1)
+        else:
+            slots.append(1 if record.stop_server else record.credits + 1)
+    slots.extend(0 for _ in range(server_slots - len(slots)))
+    admission_queue.update_estimates(slots)
+
+
+def parse_users(text: str, amount: int = 0):
+    # discord ids separated by anything, a small number after an id is that user's amount, returns ({id: amount}, skipped)
+    users = {}
+    skipped = 0
+    last = None
+    for token in re.findall(r'-?\d+|[^\d\s,;<@!>-]+', text):
+        if not re.fullmatch(r'-?\d+', token) or (token.startswith('-') and len(token) > 15):
+            # ids are never negative, only amounts are
+            skipped += 1
+        elif len(token) >= 15:
+            last = int(token)
+            users[last] = amount
+        elif last is not None:
+            users[last] = int(token)
+            last = None
+        else:
+            skipped += 1
+    return users, skipped
 
-        if person.stop_server():
-            person.set_stop_server(False)
-            break
 
-    await ctx.author.send('Your server has been stopped. Thanks for using and supporting Nextpie ❤')
-    print(f'{current_time()} - [INFO] Stopping server {server["attributes"]["id"]}')
-    return await app.suspend_server(server['attributes']['id'])
+def count_existing(connection, user_ids: list):
+    # only the requested rows, in chunks that stay under the sqlite variable limit
+    existing = 0
+    for start in range(0, len(user_ids), 500):
+        chunk = user_ids[start:start + 500]
+        existing += connection.execute(
+            f'SELECT COUNT(*) FROM users WHERE id IN ({",".join("?" * len(chunk))});', chunk
+        ).fetchone()[0]
+    return existing
+
+
+def delete_user_rows(connection, user_id: int):
+    # events after the compaction mark would count again if the same id registers later
+    connection.execute('DELETE FROM credit_events WHERE user_id=?;', (user_id,))
+    connection.execute('DELETE FROM users WHERE id=?;', (user_id,))
+
+
+def write_premium(connection, user_ids: list, status: bool, now: int):
+    existing = count_existing(connection, user_ids)
+    connection.executemany(
+        'INSERT INTO users (id, credits, premium, server_status, last_online, stop_server) VALUES (?, 0, ?, 0, ?, 0) '
+        'ON CONFLICT (id) DO UPDATE SET premium=excluded.premium;',
+        [(user_id, status, now) for user_id in user_ids]
+    )
+    return len(user_ids) - existing
+
+
+async def grant_credits(grants: dict, reason: str = 'grant', dry_run: bool = False):
+    # credits {user_id: amount} in one transaction, users without a row get one, returns a summary
+    start_time = perf_counter()
+    grants = {user_id: amount for user_id, amount in grants.items() if amount}
+    summary = {'users': len(grants), 'credits': sum(grants.values()), 'dry_run': dry_run}
+    if dry_run:
+        summary['new'] = len(grants) - await database.transaction(count_existing, list(grants))
+    elif grants:
+        # balances in memory and pending change first, exactly like a ledger entry
+        events = ledger.grant(grants, reason)
+        for user_id, amount in grants.items():
+            record = user_cache.get(user_id)
+            if record:
+                record.credits += amount
+        try:
+            summary['new'] = await database.run(ledger.write, events, [(user_id, int(time_seconds())) for user_id in grants])
+        except Exception:
+            ledger.forget(events)
+            for user_id, amount in grants.items():
+                record = user_cache.get(user_id)
+                if record:
+                    record.credits -= amount
+            raise
+        # cached as without a row, they have one now
+        for user_id in grants:
+            if user_cache.get(user_id, missing) is None:
+                user_cache.discard(user_id)
+    else:
+        summary['new'] = 0
+    summary['seconds'] = perf_counter() - start_time
+    log.info(
+        f'{"Dry run granting" if dry_run else "Granted"} {summary["credits"]} credits '
+        f'to {summary["users"]} users ({summary["new"]} new) reason: {reason} took {summary["seconds"]:.3f} seconds'
+    )
+    return summary
+
+
+async def grant_premium(user_ids: list, status: bool = True, dry_run: bool = False):
+    # sets premium for every user in one transaction, users without a row get one, returns a summary
+    start_time = perf_counter()
+    user_ids = list(dict.fromkeys(user_ids))
+    summary = {'users': len(user_ids), 'premium': status, 'dry_run': dry_run}
+    if dry_run:
+        summary['new'] = len(user_ids) - await database.transaction(count_existing, user_ids)
+    else:
+        summary['new'] = await database.transaction(write_premium, user_ids, status, int(time_seconds()))
+        for user_id in user_ids:
+            record = user_cache.get(user_id)
+            if record:
+                record.premium = status
+            elif record is None:
+                user_cache.discard(user_id)
+    summary['seconds'] = perf_counter() - start_time
+    log.info(
+        f'{"Dry run setting" if dry_run else "Set"} premium {status} for '
+        f'{summary["users"]} users ({summary["new"]} new) took {summary["seconds"]:.3f} seconds'
+    )
+    return summary
+
+
+async def read_user_list(users: str, file):
+    # ids from the command text plus an optional csv attachment
+    if file is None:
+        return users
+    return f'{users}\n{(await file.read()).decode(errors="replace")}'
+
+
+async def heartbeat():
+    # a sleep that wakes up late measures how long other callbacks held the loop
+    interval = watchdog.threshold / 4
+    loop = asyncio.get_running_loop()
+    while True:
+        start_time = loop.time()
+        await asyncio.sleep(interval)
+        loop_lag.observe(max(0, loop.time() - start_time - interval))
+        watchdog.beat()
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+def sample_stacks(thread_id: int, seconds: float, interval: float):
+    # runs on a worker thread and samples the stack of the loop thread, returns (own, total, samples)
+    own = Tally()
+    total = Tally()
+    samples = 0
+    deadline = perf_counter() + seconds
+    while perf_counter() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            samples += 1
+            own[frame_name(frame)] += 1
+            # recursion counts once per sample
+            for name in {frame_name(caller) for caller in iter_frames(frame)}:
+                total[name] += 1
+        sleep(interval)
+    return own, total, samples
+
+
+def iter_frames(frame):
+    while frame is not None:
+        yield frame
+        frame = frame.f_back
+
+
+def profile_report(own: Tally, total: Tally, samples: int, seconds: float, tasks: list):
+    lines = [f'{samples} samples over {seconds} seconds, select() is the loop waiting for work', '', 'own  total  function']
+    for name, count in own.most_common(25):
+        lines.append(f'{count / samples:5.1%} {total[name] / samples:6.1%}  {name}')
+    lines += ['', 'cumulative']
+    for name, count in total.most_common(25):
+        lines.append(f'{count / samples:6.1%}  {name}')
+    lines += ['', f'{len(tasks)} tasks alive for the whole window']
+    for (name, waiting), count in Tally(tasks).most_common():
+        lines.append(f'{count:5}  {name} waiting in {waiting}')
+    return '\n'.join(lines)
+
+
+def task_summary(task):
+    stack = task.get_stack(limit=1)
+    return task.get_coro().__qualname__, frame_name(stack[0]) if stack else 'not started'
+
+
+async def fetch_pages(function, *args):
+    # yields every page of a paginated panel listing, the first page tells how many to fetch concurrently
+    response = await function(*args, page=1)
+    yield response['data']
+    pages = response.get('meta', {}).get('pagination', {}).get('total_pages', 1)
+    for request in asyncio.as_completed([function(*args, page=page) for page in range(2, pages + 1)]):
+        yield (await request)['data']
+
+
+async def fetch_family(record, function, *args):
+    start_time = perf_counter()
+    rows = {}
+    async for page in fetch_pages(function, *args):
+        for row in page:
+            rows[row['attributes']['id']] = record.flatten(row['attributes'])
+    return rows, perf_counter() - start_time
+
+
+async def fetch_nodes():
+    # allocations are listed per node, every node is fetched concurrently once the node list is known
+    start_time = perf_counter()
+    nodes, _ = await fetch_family(PanelNode, app.get_nodes)
+    results = await asyncio.gather(
+        *(fetch_family(PanelAllocation, app.get_node_allocations, node_id) for node_id in nodes)
+    )
+    allocations = {}
+    for node_id, (rows, _) in zip(nodes, results):
+        for attributes in rows.values():
+            attributes['node'] = node_id
+        allocations.update(rows)
+    return (nodes, allocations), perf_counter() - start_time
+
+
+async def fetch_resources(identifier: str, semaphore):
+    # live state is only on the client api, the application api pydactyl wraps has none
+    async with semaphore:
+        start_time = perf_counter()
+        try:
+            async with client_session.get(f'/api/client/servers/{identifier}/resources') as response:
+                panel_latency.observe(perf_counter() - start_time, 'get_server_resources', response.status)
+                if response.status != 200:
+                    return None
+                return (await response.json())['attributes']
+        except (ClientError, asyncio.TimeoutError, KeyError) as e:
+            log.warning(f'Polling resources of {identifier} failed | {e!r}')
+            return None
+
+
+async def serve_metrics(request):
+    text = '\n'.join(line for metric in metrics for line in metric.render())
+    return web.Response(text=text + '\n', content_type='text/plain', charset='utf-8')
+
+
+async def start_metrics_server():
+    # local only by default, set metrics_port to 0 to disable
+    port = int(getenv('metrics_port', 9464))
+    if not port:
+        return
+    server = web.Application()
+    server.router.add_get('/metrics', serve_metrics)
+    runner = web.AppRunner(server, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, getenv('metrics_host', '127.0.0.1'), port).start()
+    log.info(f'Serving metrics on port {port}')
 
 
 async def is_synced(ctx):
@@ -132,72 +1562,768 @@ async def is_synced(ctx):
 
 
 # # classes
-class Person:
-    def __init__(self, user_id):
+class StallWatchdog(threading.Thread):
+    # watches the loop from outside, a late heartbeat means a callback is blocking it and its stack is logged
+    def __init__(self, threshold: float):
+        super().__init__(name='stall-watchdog', daemon=True)
+        self.threshold = threshold
+        self.loop_thread = None
+        self.heartbeat = None
+        self.last_beat = perf_counter()
+        self.stalled = False
+
+    def watch(self, loop_thread: int):
+        self.loop_thread = loop_thread
+        self.last_beat = perf_counter()
+        self.heartbeat = asyncio.ensure_future(heartbeat())
+        if not self.is_alive():
+            self.start()
+
+    def stop(self):
+        # shutdown blocks the loop on purpose, stop watching before it does
+        self.loop_thread = None
+        if self.heartbeat:
+            self.heartbeat.cancel()
+
+    def beat(self):
+        now = perf_counter()
+        if self.stalled:
+            self.stalled = False
+            log.warning(f'Event loop recovered after being blocked for {now - self.last_beat:.3f} seconds')
+        self.last_beat = now
+
+    def run(self):
+        while True:
+            sleep(self.threshold / 2)
+            blocked = perf_counter() - self.last_beat
+            if self.loop_thread is None or blocked < self.threshold or self.stalled:
+                continue
+            self.stalled = True
+            loop_stalls.inc()
+            frame = sys._current_frames().get(self.loop_thread)
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else 'stack unavailable\n'
+            log.warning(f'Event loop blocked for {blocked:.3f} seconds in\n{stack.rstrip()}')
+
+
+watchdog = StallWatchdog(float(getenv('stall_threshold', 0.25)))
+
+
+class User:
+    __slots__ = ('id', 'credits', 'premium', 'server_status', 'last_online', 'stop_server')
+
+    def __init__(self, id, credits, premium, server_status, last_online, stop_server):
+        self.id = id
+        self.credits = credits or 0
+        self.premium = bool(premium)
+        self.server_status = bool(server_status)
+        self.last_online = last_online
+        self.stop_server = bool(stop_server)
+
+
+class UserCache:
+    # LRU of users rows keyed by Discord id, None marks a user without a row,
+    # with a ttl rows are reloaded once they are older than ttl seconds
+    def __init__(self, max_size: int, ttl: float = 0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.users = OrderedDict()
+        self.loaded = {}
+
+    def __len__(self):
+        return len(self.users)
+
+    def get(self, user_id, default=None):
+        try:
+            self.users.move_to_end(user_id)
+        except KeyError:
+            return default
+        return self.users[user_id]
+
+    def put(self, user_id, record):
+        self.users[user_id] = record
+        self.users.move_to_end(user_id)
+        if self.ttl:
+            self.loaded[user_id] = time_seconds()
+        while len(self.users) > self.max_size:
+            self.loaded.pop(self.users.popitem(last=False)[0], None)
+        return record
+
+    def expired(self, user_id):
+        return bool(self.ttl) and time_seconds() - self.loaded.get(user_id, 0) > self.ttl
+
+    def setdefault(self, user_id, record):
+        if user_id in self.users and not self.expired(user_id):
+            return self.get(user_id)
+        return self.put(user_id, record)
+
+    def discard(self, user_id):
+        self.users.pop(user_id, None)
+        self.loaded.pop(user_id, None)
+
+
+class Ledger:
+    # credit changes are appended to credit_events in group commits and folded into users.credits on compaction,
+    # a balance is users.credits + events after the compaction mark + the unflushed tail
+    def __init__(self, flush_size: int):
+        self.flush_size = flush_size
+        self.buffer = []
+        self.flushing = None
+        # unflushed amount per user, shared with the database thread
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def record(self, user_id: int, amount: int, reason: str):
+        self.buffer.append((user_id, amount, reason, time_seconds()))
+        with self.lock:
+            self.pending[user_id] = self.pending.get(user_id, 0) + amount
+        if len(self.buffer) >= self.flush_size:
+            self.schedule()
+
+    def schedule(self):
+        # at most one flush runs at a time, returns it so callers can wait for it
+        if self.flushing is None and self.buffer:
+            self.flushing = asyncio.ensure_future(self.flush())
+        return self.flushing
+
+    def grant(self, grants: dict, reason: str):
+        # record() for many users at once, the returned events are written by the caller
+        now = time_seconds()
+        with self.lock:
+            for user_id, amount in grants.items():
+                self.pending[user_id] = self.pending.get(user_id, 0) + amount
+        return [(user_id, amount, reason, now) for user_id, amount in grants.items()]
+
+    def forget(self, events: list):
+        # undoes grant() when its events could not be written
+        with self.lock:
+            for user_id, amount, _, _ in events:
+                self.pending[user_id] -= amount
+                if not self.pending[user_id]:
+                    del self.pending[user_id]
+
+    def discard(self, user_id: int):
+        # drops the buffered events of a user whose data is removed, a batch already being written is deleted after it
+        removed = [event for event in self.buffer if event[0] == user_id]
+        self.buffer = [event for event in self.buffer if event[0] != user_id]
+        self.forget(removed)
+
+    def unflushed(self, user_id: int):
+        with self.lock:
+            return self.pending.get(user_id, 0)
+
+    def write(self, events: list, users: list = ()):
+        # runs on the database thread, pending only shrinks once the events are committed,
+        # users are (id, last_online) rows created first when missing, returns how many were
+        with database.connection:
+            created = database.connection.executemany(
+                'INSERT OR IGNORE INTO users (id, credits, premium, server_status, last_online, stop_server) '
+                'VALUES (?, 0, 0, 0, ?, 0);', users
+            ).rowcount if users else 0
+            database.connection.executemany(
+                'INSERT INTO credit_events (user_id, amount, reason, created) VALUES (?, ?, ?, ?);', events
+            )
+        self.forget(events)
+        return created
+
+    async def flush(self):
+        try:
+            while self.buffer:
+                events, self.buffer = self.buffer, []
+                write = asyncio.ensure_future(database.run(self.write, events))
+                try:
+                    await asyncio.shield(write)
+                except asyncio.CancelledError:
+                    # the batch already left the buffer, let it finish or put it back before the cancellation goes on
+                    try:
+                        await write
+                    except BaseException:
+                        if not write.done() or write.cancelled() or write.exception():
+                            self.buffer[:0] = events
+                    raise
+                except Exception as e:
+                    # keep the events for the next flush, the balances in memory already include them
+                    self.buffer[:0] = events
+                    log.error(f'Flushing {len(events)} credit events | {e}')
+                    return
+        finally:
+            self.flushing = None
+
+    @staticmethod
+    def compact(connection):
+        mark = connection.execute("SELECT value FROM ledger_state WHERE key='compacted';").fetchone()
+        mark = mark[0] if mark else 0
+        last = connection.execute('SELECT MAX(id) FROM credit_events;').fetchone()[0]
+        if last is None or last <= mark:
+            return 0
+        connection.execute(
+            'UPDATE users SET credits = credits + '
+            '(SELECT SUM(amount) FROM credit_events WHERE user_id = users.id AND id > ? AND id <= ?) '
+            'WHERE id IN (SELECT user_id FROM credit_events WHERE id > ? AND id <= ?);',
+            (mark, last, mark, last)
+        )
+        connection.execute("INSERT OR REPLACE INTO ledger_state (key, value) VALUES ('compacted', ?);", (last,))
+        return last - mark
+
+    def read_user(self, user_id: int):
+        # runs on the database thread so no flush can land between the query and reading pending
+        row = database.connection.execute(
+            'SELECT users.*, COALESCE((SELECT SUM(amount) FROM credit_events WHERE user_id = users.id AND id > '
+            "COALESCE((SELECT value FROM ledger_state WHERE key='compacted'), 0)), 0) FROM users WHERE id=?;",
+            (user_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        record = User(*row[:6])
+        record.credits += row[6] + self.unflushed(user_id)
+        return record
+
+    def read_users(self, user_ids: list):
+        return [self.read_user(user_id) for user_id in user_ids]
+
+
+ledger = Ledger(int(getenv('ledger_flush_size', 500)))
+# other cluster workers write the same rows, so cached rows go stale there
+user_cache = UserCache(int(getenv('user_cache_size', 10000)), float(getenv('cluster_cache_ttl', 5)) if clustered else 0)
+missing = object()
+
+
+class PanelRecord:
+    __slots__ = ()
+
+    def __init__(self, attributes: dict):
+        for field in self.__slots__:
+            setattr(self, field, attributes[field])
+
+    @staticmethod
+    def flatten(attributes: dict):
+        return attributes
+
+    def matches(self, attributes: dict):
+        return all(getattr(self, field) == attributes[field] for field in self.__slots__)
+
+    def attributes(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+
+class PanelUser(PanelRecord):
+    __slots__ = ('id', 'username', 'email')
+
+
+class PanelServer(PanelRecord):
+    __slots__ = (
+        'id', 'identifier', 'name', 'user', 'node', 'allocation', 'suspended', 'status', 'memory', 'disk', 'cpu'
+    )
+
+    @staticmethod
+    def flatten(attributes: dict):
+        # status is installing, install_failed or reinstall_failed until the egg is installed, then None,
+        # since panel 1.7 a suspended server reports status suspended and the suspended flag is deprecated
+        limits = attributes['limits']
+        status = attributes.get('status')
+        return {
+            **attributes, 'status': status, 'suspended': status == 'suspended' or bool(attributes.get('suspended')),
+            'memory': limits['memory'], 'disk': limits['disk'], 'cpu': limits['cpu']
+        }
+
+    def installed(self):
+        return self.status in (None, 'suspended')
+
+
+class PanelNode(PanelRecord):
+    __slots__ = ('id', 'name', 'maintenance_mode', 'memory', 'memory_overallocate', 'disk', 'disk_overallocate')
+
+
+class PanelAllocation(PanelRecord):
+    __slots__ = ('id', 'node', 'ip', 'port', 'assigned')
+
+
+# 400% cpu | 3GB(3072) ram | 1GB(1024) storage | per server
+server_profile = (3072, 1024, 400)
+# cpu is not tracked by the panel, 0 leaves it unlimited
+node_cpu = int(getenv('node_cpu', 0))
+
+
+def least_loaded(candidates: list):
+    # spread servers over the node with the most free memory
+    return max(candidates, key=lambda candidate: candidate[1][0])
+
+
+def bin_packing(candidates: list):
+    # fill the fullest node that still fits so whole nodes stay free
+    return min(candidates, key=lambda candidate: candidate[1][0])
+
+
+placement_strategies = {'least_loaded': least_loaded, 'bin_packing': bin_packing}
+
+
+class PanelCache:
+    # indexed snapshot of the panel, refreshes build a patched copy and swap it in as a whole
+    def __init__(self):
+        self.users = {}
+        self.user_ids = {}
+        self.servers = {}
+        self.user_servers = {}
+        self.nodes = {}
+        self.node_usage = {}
+        # allocation ids of cached servers, a reserved allocation in here is already counted in node_usage
+        self.server_allocations = set()
+        self.allocations = {}
+        self.free_allocations = {}
+        # allocations handed out locally that the panel does not report as assigned yet
+        self.reserved = set()
+        # (family, id) of entities patched after a mutation, with the time of the patch
+        self.patched = {}
+
+    def copy(self):
+        cache = PanelCache()
+        cache.users = self.users
+        cache.user_ids = self.user_ids
+        cache.servers = self.servers
+        cache.user_servers = self.user_servers
+        cache.nodes = self.nodes
+        cache.node_usage = self.node_usage
+        cache.server_allocations = self.server_allocations
+        cache.allocations = self.allocations
+        cache.free_allocations = self.free_allocations
+        cache.reserved = self.reserved
+        cache.patched = self.patched
+        return cache
+
+    def apply(
+        self, users: dict = None, servers: dict = None, nodes: dict = None, allocations: dict = None,
+        partial: bool = False
+    ):
+        # arguments map panel id to attributes, None leaves that family untouched, returns (cache, changes),
+        # a partial apply only touches the ids given and an id mapped to None is deleted
+        cache = self.copy()
+        changes = 0
+
+        def removed(old: dict, new: dict):
+            if partial:
+                return [entity_id for entity_id, attributes in new.items() if attributes is None and entity_id in old]
+            return old.keys() - new.keys()
+
+        if users is not None:
+            cache.users = self.users.copy()
+            cache.user_ids = self.user_ids.copy()
+            for user_id in removed(self.user_ids, users):
+                del cache.users[cache.user_ids.pop(user_id).username]
+                changes += 1
+            for attributes in users.values():
+                if attributes is None:
+                    continue
+                old = self.user_ids.get(attributes['id'])
+                if old and old.matches(attributes):
+                    continue
+                if old:
+                    del cache.users[old.username]
+                user = PanelUser(attributes)
+                cache.users[user.username] = user
+                cache.user_ids[user.id] = user
+                changes += 1
+
+        if servers is not None:
+            cache.servers = self.servers.copy()
+            cache.user_servers = self.user_servers.copy()
+            cache.node_usage = {node_id: list(usage) for node_id, usage in self.node_usage.items()}
+            cache.server_allocations = self.server_allocations.copy()
+            copied = set()
+
+            def owned(owner):
+                if owner not in copied:
+                    copied.add(owner)
+                    cache.user_servers[owner] = list(cache.user_servers.get(owner, ()))
+                return cache.user_servers.setdefault(owner, [])
+
+            def count(server, sign: int):
+                usage = cache.node_usage.setdefault(server.node, [0, 0, 0])
+                usage[0] += sign * server.memory
+                usage[1] += sign * server.disk
+                usage[2] += sign * server.cpu
+
+            def remove(server):
+                del cache.servers[server.id]
+                owned(server.user).remove(server)
+                cache.server_allocations.discard(server.allocation)
+                count(server, -1)
+
+            for server_id in removed(self.servers, servers):
+                remove(self.servers[server_id])
+                changes += 1
+            for attributes in servers.values():
+                if attributes is None:
+                    continue
+                old = self.servers.get(attributes['id'])
+                if old and old.matches(attributes):
+                    continue
+                if old:
+                    remove(old)
+                server = PanelServer(attributes)
+                cache.servers[server.id] = server
+                owned(server.user).append(server)
+                cache.server_allocations.add(server.allocation)
+                count(server, 1)
+                changes += 1
+            for owner in copied:
+                if not cache.user_servers[owner]:
+                    del cache.user_servers[owner]
+
+        if nodes is not None:
+            cache.nodes = {}
+            for attributes in nodes.values():
+                old = self.nodes.get(attributes['id'])
+                if old and old.matches(attributes):
+                    cache.nodes[old.id] = old
+                else:
+                    cache.nodes[attributes['id']] = PanelNode(attributes)
+                    changes += 1
+            changes += len(self.nodes.keys() - nodes.keys())
+
+        if allocations is not None:
+            cache.allocations = self.allocations.copy()
+            allocation_changes = 0
+            for allocation_id in removed(self.allocations, allocations):
+                del cache.allocations[allocation_id]
+                allocation_changes += 1
+            for attributes in allocations.values():
+                if attributes is None:
+                    continue
+                old = self.allocations.get(attributes['id'])
+                if old and old.matches(attributes):
+                    continue
+                cache.allocations[attributes['id']] = PanelAllocation(attributes)
+                allocation_changes += 1
+                if attributes['assigned']:
+                    self.reserved.discard(attributes['id'])
+            if allocation_changes:
+                cache.free_allocations = {}
+                for allocation in cache.allocations.values():
+                    if not allocation.assigned and allocation.id not in cache.reserved:
+                        cache.free_allocations.setdefault(allocation.node, []).append(allocation)
+            changes += allocation_changes
+
+        return cache, changes
+
+    def headroom(self, node):
+        # free (memory, disk, cpu) on a node counting servers reserved here but not on the panel yet
+        used = list(self.node_usage.get(node.id, (0, 0, 0)))
+        for allocation_id in self.reserved - self.server_allocations:
+            allocation = self.allocations.get(allocation_id)
+            if allocation and allocation.node == node.id:
+                used = [amount + needed for amount, needed in zip(used, server_profile)]
+        capacity = [
+            node.memory * (1 + node.memory_overallocate / 100) if node.memory_overallocate >= 0 else float('inf'),
+            node.disk * (1 + node.disk_overallocate / 100) if node.disk_overallocate >= 0 else float('inf'),
+            node_cpu or float('inf')
+        ]
+        return tuple(total - amount for total, amount in zip(capacity, used))
+
+    def place(self, strategy):
+        # picks a node with room for one more server and reserves an allocation on it, never awaits
+        candidates = []
+        for node in self.nodes.values():
+            if node.maintenance_mode or not self.free_allocations.get(node.id):
+                continue
+            room = self.headroom(node)
+            if all(free >= needed for free, needed in zip(room, server_profile)):
+                candidates.append((node, room))
+
+        while candidates:
+            candidate = strategy(candidates)
+            allocation = self.take_allocation(candidate[0].id)
+            if allocation:
+                return allocation
+            candidates.remove(candidate)
+        return None
+
+    def take_allocation(self, node_id: int):
+        free_allocations = self.free_allocations.get(node_id, [])
+        while free_allocations:
+            allocation = free_allocations.pop()
+            if allocation.id not in self.reserved:
+                self.reserved.add(allocation.id)
+                return allocation
+        return None
+
+    def release_allocation(self, allocation):
+        self.reserved.discard(allocation.id)
+        self.free_allocations.setdefault(allocation.node, []).append(allocation)
+
+
+panel_cache = PanelCache()
+placement_strategy = placement_strategies[getenv('placement_strategy', 'least_loaded')]
+panel_families = (
+    ('users', PanelUser, 'user_ids'),
+    ('servers', PanelServer, 'servers'),
+    ('nodes', PanelNode, 'nodes'),
+    ('allocations', PanelAllocation, 'allocations')
+)
+
+
+class Session:
+    # a running server, billing starts one minute after started to give the user time to start it,
+    # billed is the last charge and survives restarts so a restart never charges early,
+    # online and idle_since come from the resource poller and are not persisted
+    __slots__ = ('user_id', 'server_id', 'started', 'billed', 'online', 'idle_since')
+
+    def __init__(self, user_id: int, server_id: int, started: float = None, billed: float = None):
         self.user_id = user_id
-        self.exists = True if db_get('SELECT * FROM users WHERE id=?;', (self.user_id,)) else False
+        self.server_id = server_id
+        self.started = time_seconds() if started is None else started
+        self.billed = self.started if billed is None else billed
+        self.online = True
+        self.idle_since = None
+
+
+priority_stop = 0
+priority_warning = 1
+priority_info = 2
+
+
+class MessageDispatcher:
+    # sends direct messages from one worker, highest priority first, each recipient waits message_interval between sends
+    def __init__(self, interval: float, concurrency: int):
+        self.interval = interval
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.heap = []
+        self.ready_at = {}
+        self.busy = set()
+        self.counter = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.worker = None
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, priority: int, route, payload):
+        heapq.heappush(self.heap, (priority, next(self.counter), route, payload))
+        self.wakeup.set()
+
+    def send(self, user_id: int, content: str, priority: int = None):
+        self.push(priority_info if priority is None else priority, ('dm', user_id), content)
+
+    def start(self):
+        if self.worker is None:
+            self.worker = asyncio.ensure_future(self.run())
+
+    async def flush(self, timeout: float):
         try:
-            self.premium = True if db_get('SELECT premium FROM users WHERE id=?;', (self.user_id,))[0] else False
-        except TypeError:
-            self.premium = False
+            await asyncio.wait_for(self.drained(), timeout)
+        except asyncio.TimeoutError:
+            log.warning(f'Dropped {len(self.heap)} outbound messages on shutdown')
+
+    async def drained(self):
+        while self.heap or self.busy:
+            await asyncio.sleep(0.1)
+
+    def next_item(self):
+        # the highest priority item whose route is free, otherwise how long until one frees up
+        now = asyncio.get_running_loop().time()
+        waiting = []
+        item = None
+        while self.heap:
+            candidate = heapq.heappop(self.heap)
+            route = candidate[2]
+            if route not in self.busy and self.ready_at.get(route, 0) <= now:
+                item = candidate
+                break
+            waiting.append(candidate)
+        for candidate in waiting:
+            heapq.heappush(self.heap, candidate)
+        delay = min((self.ready_at.get(candidate[2], now) - now for candidate in waiting), default=None)
+        return item, delay
+
+    async def run(self):
+        while True:
+            item, delay = self.next_item()
+            if item is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay if delay and delay > 0 else None)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self.semaphore.acquire()
+            self.busy.add(item[2])
+            asyncio.ensure_future(self.deliver(item[2], item[3]))
+
+    async def deliver(self, route, payload):
+        try:
+            user = bot.get_user(route[1]) or await bot.fetch_user(route[1])
+            await user.send(payload)
+        except discord.HTTPException as e:
+            log.error(f'sending {route[0]} to {route[1]} | {e}')
+        finally:
+            now = asyncio.get_running_loop().time()
+            if len(self.ready_at) > 10000:
+                self.ready_at = {key: ready for key, ready in self.ready_at.items() if ready > now}
+            self.ready_at[route] = now + self.interval
+            self.busy.discard(route)
+            self.semaphore.release()
+            self.wakeup.set()
+
+
+dispatcher = MessageDispatcher(float(getenv('message_interval', 1)), int(getenv('message_concurrency', 5)))
+
+
+class AdmissionQueue:
+    # FIFO of users waiting for a slot, premium users are admitted before everyone else
+    def __init__(self):
+        self.premium = deque()
+        self.regular = deque()
+        self.estimates = {}
+        self.next_estimate = 0
+
+    def __len__(self):
+        return len(self.premium) + len(self.regular)
+
+    def __contains__(self, user_id):
+        return user_id in self.estimates
+
+    def __iter__(self):
+        yield from self.premium
+        yield from self.regular
+
+    def push(self, user_id: int, premium: bool):
+        (self.premium if premium else self.regular).append(user_id)
+        self.estimates[user_id] = (len(self), self.next_estimate)
+
+    def peek(self):
+        queue = self.premium or self.regular
+        return queue[0] if queue else None
+
+    def pop(self):
+        queue = self.premium or self.regular
+        if not queue:
+            return None
+        user_id = queue.popleft()
+        self.estimates.pop(user_id, None)
+        return user_id
+
+    def remove(self, user_id: int):
+        for queue in (self.premium, self.regular):
+            if user_id in queue:
+                queue.remove(user_id)
+        self.estimates.pop(user_id, None)
+
+    def load(self, rows: list):
+        # rows of (user_id, premium, position, minutes) in the order they joined
+        self.premium = deque(user_id for user_id, premium, _, _ in rows if premium)
+        self.regular = deque(user_id for user_id, premium, _, _ in rows if not premium)
+        self.estimates = {user_id: (position, minutes) for user_id, _, position, minutes in rows}
+
+    def estimate(self, user_id: int = None):
+        # (position, minutes) for a queued user, or for whoever joins next
+        if user_id is None:
+            return len(self) + 1, self.next_estimate
+        return self.estimates[user_id]
+
+    def update_estimates(self, slots: list):
+        heap = list(slots) or [0]
+        heapq.heapify(heap)
+        for position, user_id in enumerate(self, start=1):
+            minutes = heapq.heappop(heap)
+            self.estimates[user_id] = (position, minutes)
+            record = user_cache.get(user_id)
+            heapq.heappush(heap, minutes + (record.credits + 1 if record else 60))
+        self.next_estimate = heap[0]
+
+
+admission_queue = AdmissionQueue()
+
 
-    def init(self, amount: int, premium: bool):
-        output = db_exec(
+class Person:
+    # view on a cached users row, reads are free, credit changes go to the ledger and other writes to the database
+    def __init__(self, user_id, record=None):
+        self.user_id = user_id
+        self._record = record
+
+    @classmethod
+    async def get(cls, user_id):
+        record = user_cache.get(user_id, missing)
+        if record is missing or user_cache.expired(user_id):
+            try:
+                loaded = await database.run(ledger.read_user, user_id)
+            except Exception as e:
+                log.error(f'Database error | {e}')
+                return cls(user_id, None if record is missing else record)
+            record = user_cache.setdefault(user_id, loaded)
+        return cls(user_id, record)
+
+    @property
+    def record(self):
+        record = user_cache.get(self.user_id, missing)
+        if record is missing:
+            # evicted while this view was alive, outside a cluster nothing else can have written it
+            record = self._record
+            if record is not None and not clustered:
+                user_cache.put(self.user_id, record)
+        self._record = record
+        return record
+
+    @property
+    def exists(self):
+        return self.record is not None
+
+    @property
+    def premium(self):
+        return self.exists and self.record.premium
+
+    async def init(self, amount: int, premium: bool, reason: str = 'init'):
+        record = User(self.user_id, 0, premium, False, int(time_seconds()), False)
+        output = await db_exec(
             'INSERT INTO users (id, credits, premium, server_status, last_online, stop_server) '
             'VALUES (?, ?, ?, ?, ?, ?);',
-            (self.user_id, amount, premium, False, time_seconds(), False)
+            (record.id, record.credits, record.premium, record.server_status, record.last_online, record.stop_server)
         )
+        if output:
+            self._record = user_cache.put(self.user_id, record)
+            if amount:
+                record.credits += amount
+                ledger.record(self.user_id, amount, reason)
         return output
 
     def get_credits(self):
-        output = db_get('SELECT credits FROM users WHERE id=?', (self.user_id,))
-        if output and isinstance(output, tuple):
-            credits = output[0]
-        else:
-            credits = 0
-        return credits
+        return self.record.credits if self.exists else 0
 
-    def update_credits(self, amount: int):
+    async def update_credits(self, amount: int, reason: str = 'update'):
         if self.exists:
-            new_amount = db_get('SELECT credits FROM users WHERE id=?', (self.user_id,))[0] + amount
-            output = db_exec('UPDATE users SET credits=? WHERE id=?', (new_amount, self.user_id))
-        else:
-            output = self.init(amount, False)
-        return output
+            self.record.credits += amount
+            ledger.record(self.user_id, amount, reason)
+            return True
+        return await self.init(amount, False, reason)
 
-    def set_server_status(self, status: bool):
+    async def set_server_status(self, status: bool):
         if self.exists:
-            output = db_exec('UPDATE users SET server_status=? WHERE id=?', (status, self.user_id))
+            output = await db_exec('UPDATE users SET server_status=? WHERE id=?', (status, self.user_id))
+            if output:
+                self.record.server_status = status
             return output
         else:
             return False
 
     def has_server(self):
-        if self.exists:
-            output = db_get('SELECT server_status FROM users WHERE id=?', (self.user_id,))
-            return output[0]
-        else:
-            return False
+        return self.exists and self.record.server_status
 
-    def set_stop_server(self, status=bool):
+    async def set_stop_server(self, status=bool):
         if self.exists:
-            return db_exec('UPDATE users SET stop_server=? WHERE id=?', (status, self.user_id))
+            output = await db_exec('UPDATE users SET stop_server=? WHERE id=?', (status, self.user_id))
+            if output:
+                self.record.stop_server = status
+            return output
         else:
             return False
 
     def stop_server(self):
-        if self.exists:
-            output = db_get('SELECT stop_server FROM users WHERE id=?', (self.user_id,))
-            return output[0]
-        else:
-            return False
+        return self.exists and self.record.stop_server
 
-    def set_premium(self, status: bool):
+    async def set_premium(self, status: bool):
         if self.exists:
-            output = db_exec('UPDATE users SET premium=? WHERE id=?', (status, self.user_id))
+            output = await db_exec('UPDATE users SET premium=? WHERE id=?', (status, self.user_id))
+            if output:
+                self.record.premium = status
         else:
-            output = self.init(0, status)
-        self.premium = status
+            output = await self.init(0, status)
         return output
 
 
@@ -223,13 +2349,14 @@ class RegisterButtons(discord.ui.View):
                 return await interaction.response.edit_message(content='You already have an account.', view=None)
             return await interaction.response.edit_message(content=response['errors'][0]['detail'], view=None)
 
-        print(
-            f'{current_time()} - [INFO] Created an account for '
+        patch_cache(users={response['attributes']['id']: response['attributes']})
+        log.info(
+            f'Created an account for '
             f'{self.ctx.author.display_name}#{self.ctx.author.discriminator}'
         )
         return await interaction.response.edit_message(
             content='Created your account! Please check your email to verify your account. '
-                    '(**It can take up to 5 minutes for everything to sync**)',
+                    'You can start your server right away.',
             view=None
         )
 
@@ -243,69 +2370,335 @@ class RegisterButtons(discord.ui.View):
 
 
 # # events
+@bot.before_invoke
+async def before_command(ctx):
+    ctx.started = perf_counter()
+    touch(ctx.author.id)
+    # every record logged while the command runs carries these
+    log_context.set({
+        'command': ctx.command.qualified_name, 'user_id': ctx.author.id,
+        'shard': ctx.guild.shard_id if ctx.guild else 0
+    })
+
+
+@bot.after_invoke
+async def after_command(ctx):
+    command_latency.observe(
+        perf_counter() - ctx.started, ctx.command.qualified_name, 'error' if ctx.command_failed else 'ok'
+    )
+
+
+@bot.event
+async def on_shard_ready(shard_id):
+    if 'gateway' not in startup_phases:
+        report_startup()
+
+
 @bot.event
 async def on_ready():
-    global startup, variables_synced
-    print(f'{current_time()} - [INFO] {bot.user.name} syncing command tree')
-    # await bot.tree.sync()
+    global startup
     if startup:
-        update_cache.start()
-        print(f'{current_time()} - [INFO] Sleeping 5 seconds to allow cache to sync')
-        await asyncio.sleep(5)
-        await clear_queue()
-        purge_servers.start()
         startup = False
-        variables_synced = True
-    print(f'{current_time()} - [INFO] {bot.user.name} connected to a shard')
+        if leader:
+            bot.loop.create_task(sync_commands())
+            purge_servers.start()
+            if getenv('client_api_key'):
+                poll_resources.start()
+            if pool_size:
+                refill_pool.start()
+            bot.loop.create_task(reconcile())
+        else:
+            cluster_sync.start()
+    log.info(f'{bot.user.name} connected to a shard')
     await bot.change_presence(activity=discord.Activity(type=discord.ActivityType.watching, name='your server'))
 
 
-@tasks.loop(seconds=300)
+@tasks.loop(seconds=int(getenv('cache_interval', 60)))
 async def update_cache():
-    start_time = time_seconds()
-    await bot.change_presence(activity=discord.Activity(type=discord.ActivityType.watching, name='refreshing cache'))
-    global panel_users, panel_servers, panel_allocations
-    panel_users = (await app.get_users())['data']
-    panel_servers = (await app.get_servers())['data']
-    panel_allocations = (await app.get_node_allocations(1))['data']
-    break_time = str((time_seconds() - start_time)).split('.')
-    total_time = break_time[0] + '.' + break_time[1][:4] + '...'
-    print(f'{current_time()} - [INFO] Updated local cache took {total_time} seconds')
-    await bot.change_presence(activity=discord.Activity(type=discord.ActivityType.watching, name='your server'))
+    await refresh_cache()
+
+
+async def refresh_cache():
+    global panel_cache
+    start_time = perf_counter()
+    fetched = time_seconds()
+    results = await asyncio.gather(
+        fetch_family(PanelUser, app.get_users),
+        fetch_family(PanelServer, app.get_servers),
+        fetch_nodes(),
+        return_exceptions=True
+    )
+
+    families = {}
+    latency = []
+    for name, result in zip(('users', 'servers', 'nodes'), results):
+        if isinstance(result, Exception):
+            # keep the cached copy of this family until the next refresh succeeds
+            log.error(f'Refreshing {name} | {result!r}')
+            continue
+        if name == 'nodes':
+            families['nodes'], families['allocations'] = result[0]
+        else:
+            families[name] = result[0]
+        latency.append(f'{name}={result[1]:.3f}s')
+    keep_patched(families, fetched)
+    panel_cache, changes = panel_cache.apply(**families)
+
+    total_time = perf_counter() - start_time
+    cache_refresh_latency.observe(total_time)
+    for family, _, index in panel_families:
+        cache_size.set(len(getattr(panel_cache, index)), family)
+    rows = sum(len(family) for family in families.values())
+    log.info(
+        f'Updated local cache took {total_time:.3f} seconds | {rows} rows '
+        f'({rows / total_time:.0f} rows/s) {changes} changed | {" ".join(latency)}'
+    )
+    if changes:
+        await save_snapshot(fetched)
+
+
+@tasks.loop(seconds=float(getenv('cluster_sync_interval', 2)))
+async def cluster_sync():
+    await sync_cluster()
+
+
+@tasks.loop(seconds=float(getenv('resource_interval', 30)))
+async def poll_resources():
+    global client_session
+    sessions = [session for session in running_servers.values() if session.server_id in panel_cache.servers]
+    if not sessions:
+        return
+    if client_session is None:
+        client_session = ClientSession(
+            base_url=getenv('pterodactyl_site'),
+            headers={'Authorization': f'Bearer {getenv("client_api_key")}', 'Accept': 'application/json'},
+            timeout=ClientTimeout(total=10)
+        )
+
+    # one cycle polls every running server, bounded like the other bulk panel work
+    semaphore = asyncio.Semaphore(int(getenv('bulk_concurrency', 16)))
+    results = await asyncio.gather(
+        *(fetch_resources(panel_cache.servers[session.server_id].identifier, semaphore) for session in sessions)
+    )
+    now = time_seconds()
+    idle = []
+    for session, attributes in zip(sessions, results):
+        if attributes is None:
+            # unknown keeps the last known state
+            continue
+        state = attributes['current_state']
+        session.online = state != 'offline'
+        # players are not reported by the panel, a server nobody plays on sits near zero cpu
+        if state == 'starting' or (state == 'running' and attributes['resources']['cpu_absolute'] >= idle_cpu):
+            session.idle_since = None
+        elif session.idle_since is None:
+            session.idle_since = now
+        elif now - session.idle_since >= idle_minutes * 60:
+            idle.append(session)
+
+    for session in idle:
+        idle_suspensions.inc()
+        log.info(
+            f'Server {session.server_id} idle for {idle_minutes:g} minutes',
+            extra={'server_id': session.server_id, 'user_id': session.user_id}
+        )
+    await asyncio.gather(*(
+        stop_session(session, f'Your server has been stopped after {idle_minutes:g} minutes without activity.')
+        for session in idle if session.user_id in running_servers
+    ), return_exceptions=True)
+    if idle:
+        await admit_queue()
+
+
+@poll_resources.error
+async def restart_polling(error):
+    log.error(f'Polling resources failed, restarting | {error!r}')
+    restart_loop(poll_resources)
+
+
+@tasks.loop(seconds=float(getenv('pool_interval', 60)))
+async def refill_pool():
+    # at most one server is created per tick so the pool refills at a steady rate
+    pool = panel_cache.user_servers.get(pool_user, ())
+    installing = [server.id for server in pool if server.status == 'installing']
+    await asyncio.gather(*(refresh_server(server_id) for server_id in installing), return_exceptions=True)
+
+    pool = list(panel_cache.user_servers.get(pool_user, ()))
+    failed = [server.id for server in pool if server.status in ('install_failed', 'reinstall_failed')]
+    installed = [server.id for server in pool if server.installed() and not server.suspended]
+    if failed:
+        results = await bulk_action('delete_server', failed)
+        patch_cache(servers={server_id: None for server_id, status in results.items() if status in (204, 404)})
+        log.warning(f'Removed {len(failed)} warm servers that failed to install')
+    if installed:
+        results = await bulk_action('suspend_server', installed)
+        patch_suspended([server_id for server_id, status in results.items() if status == 204], True)
+
+    if len(pool) - len(failed) >= pool_size:
+        return
+    allocation = await reserve_allocation()
+    if allocation is None:
+        return log.warning('No room left to add a warm server')
+    server = await create_paper_server(pool_user, allocation)
+    if 'errors' in server:
+        panel_cache.release_allocation(allocation)
+        return log.error(f'Creating warm server | {server["errors"][0]["detail"]}')
+    patch_cache(servers={server['attributes']['id']: PanelServer.flatten(server['attributes'])})
+    log.info(
+        f'Added warm server {server["attributes"]["id"]} '
+        f'({len(pool) - len(failed) + 1}/{pool_size})'
+    )
+
+
+@tasks.loop(seconds=60)
+async def bill_servers():
+    if clustered:
+        # sessions, queued users and balances may have been written by any worker
+        await sync_cluster()
+    now = time_seconds()
+    due = [session for session in running_servers.values() if now - session.billed >= 60]
+    if clustered and due:
+        try:
+            records = await database.run(ledger.read_users, [session.user_id for session in due])
+            for session, record in zip(due, records):
+                user_cache.put(session.user_id, record)
+        except Exception as e:
+            log.error(f'Reloading balances | {e}')
+    if not due:
+        return await admit_queue()
+
+    # balances live in the user cache, charging only appends to the ledger
+    people = await asyncio.gather(*(Person.get(session.user_id) for session in due))
+    stopping = []
+    billed = []
+    for session, person in zip(due, people):
+        if person.stop_server() or person.get_credits() < 1:
+            stopping.append(session)
+            continue
+        if not session.online:
+            # billing pauses while the server is offline, the poller suspends it once it stays idle
+            continue
+        touch(session.user_id)
+        await person.update_credits(-1, 'billing')
+        session.billed = now
+        billed.append(session.user_id)
+        if person.get_credits() == 0:
+            send_dm(
+                session.user_id, 'You are running out of credits. Your server will stop in 60 seconds.',
+                priority_warning
+            )
+
+    if billed:
+        await db_exec(
+            f'UPDATE sessions SET billed=? WHERE user_id IN ({",".join("?" * len(billed))})', (now, *billed)
+        )
+    if stopping:
+        user_ids = tuple(session.user_id for session in stopping)
+        await db_exec(f'UPDATE users SET stop_server=0 WHERE id IN ({",".join("?" * len(user_ids))})', user_ids)
+        for user_id in user_ids:
+            record = user_cache.get(user_id)
+            if record:
+                record.stop_server = False
+    await asyncio.gather(*(stop_session(session) for session in stopping), return_exceptions=True)
+    await admit_queue()
+
+
+@bill_servers.error
+async def restart_billing(error):
+    # one bad tick must not leave every running server unbilled until a restart
+    log.error(f'Billing failed, restarting | {error!r}')
+    restart_loop(bill_servers)
+
+
+@tasks.loop(seconds=float(getenv('ledger_interval', 0.25)))
+async def flush_ledger():
+    flushing = ledger.schedule()
+    if flushing:
+        # cancelling the loop must not cancel the flush, close() waits for it
+        await asyncio.shield(flushing)
+
+
+@tasks.loop(minutes=10)
+async def compact_ledger():
+    start_time = perf_counter()
+    try:
+        events = await database.transaction(Ledger.compact)
+    except Exception as e:
+        return log.error(f'Compacting credit ledger | {e}')
+    if events:
+        log.info(
+            f'Compacted {events} credit events '
+            f'took {perf_counter() - start_time:.3f} seconds'
+        )
+
+
+@tasks.loop(seconds=float(getenv('activity_interval', 60)))
+async def flush_activity():
+    await save_activity()
 
 
 @tasks.loop(hours=24)
 async def purge_servers():
     start_time = time_seconds()
-    print(f'{current_time()} - [INFO] Purging servers')
-    server_count = 0
-    print(
-        f'{current_time()} - [INFO] Purge done removed {server_count} servers '
-        f'took {time_seconds() - start_time} seconds'
+    log.info('Purging servers')
+    await save_activity()
+    cutoff = int(time_seconds() - float(getenv('purge_days', 30)) * 86400)
+    rows = await db_all('SELECT id FROM users WHERE last_online < ?;', (cutoff,))
+    if rows is False:
+        return
+
+    # users with a session or a place in the queue are active whatever last_online says
+    inactive = {}
+    for user_id, in rows:
+        if user_id in running_servers or user_id in starting or user_id in admission_queue:
+            continue
+        user = panel_cache.users.get(str(user_id))
+        servers = panel_cache.user_servers.get(user.id, ()) if user else ()
+        inactive[user_id] = [server.id for server in servers if server.id not in (1, 3)]
+
+    results = await bulk_action('delete_server', [server_id for servers in inactive.values() for server_id in servers])
+    for server_id, status in results.items():
+        if status not in (204, 404):
+            log.error(f'Deleting server {server_id} | code: {status}')
+    patch_cache(servers={server_id: None for server_id, status in results.items() if status in (204, 404)})
+
+    # only users who lost every server can create a new one
+    purged = [
+        user_id for user_id, servers in inactive.items()
+        if all(results.get(server_id) in (204, 404) for server_id in servers)
+    ]
+    try:
+        await database.transaction(reset_server_status, purged)
+    except Exception as e:
+        log.error(f'Resetting server status of {len(purged)} users | {e}')
+    else:
+        for user_id in purged:
+            record = user_cache.get(user_id)
+            if record:
+                record.server_status = False
+    server_count = sum(status in (204, 404) for status in results.values())
+    log.info(
+        f'Purge done removed {server_count} servers of {len(inactive)} inactive users '
+        f'took {time_seconds() - start_time:.3f} seconds'
     )
 
 
+@purge_servers.before_loop
+async def delay_purge():
+    # not on boot, reconcile() refreshes the cache and activity of the previous run is saved first
+    await asyncio.sleep(float(getenv('purge_delay', 3600)))
+
+
 @bot.event
 async def on_command_error(ctx, error):
     if isinstance(error, commands.CommandOnCooldown):
-        time = str(timedelta(seconds=error.retry_after)).split(':')
-        message = await ctx.send(
-            f'Please wait `{time[0]}`:`{time[1]}`:`{(time[2])[:2]}` before using this command.'
+        # discord renders the relative timestamp as a live countdown, no edits needed
+        until = datetime.now(timezone.utc) + timedelta(seconds=error.retry_after)
+        return await ctx.send(
+            f'Please wait until {discord.utils.format_dt(until, "R")} before using this command.',
+            delete_after=min(error.retry_after, 5)
         )
 
-        if error.retry_after < 5:
-            loop_count = int(error.retry_after)
-        else:
-            loop_count = 5
-
-        for i in range(1, loop_count):
-            time = str(timedelta(seconds=error.retry_after - i)).split(':')
-            await message.edit(
-                content=f'Please wait `{time[0]}`:`{time[1]}`:`{(time[2])[:2]}` before using this command.'
-            )
-            await asyncio.sleep(1)
-        return await message.delete()
-
 
 # # commands
 @bot.hybrid_command(description='Help command if you get stuck.')
@@ -393,28 +2786,39 @@ async def register(ctx, email: str):  # , first_name: str, last_name: str):
 @commands.cooldown(1, 3600, commands.BucketType.user)
 async def withdraw(ctx):
     message = await ctx.send('Collecting your data... please wait')
-    for user in panel_users:
-        if user['attributes']['username'] == str(ctx.author.id):
-            user_panel_id = user['attributes']['id']
-
-            # remove user servers
-            for server in panel_servers:
-                if server['attributes']['user'] == user_panel_id:
-                    output = await app.delete_server(server['attributes']['id'])
-
-            # remove user
-            output = await app.delete_user(user_panel_id)
-            
-            if 'errors' in output:
-                print(f'{current_time()} - [ERROR] User {user_panel_id} | {output["errors"][0]["detail"]}')
-            else:
-                print(f'{current_time()} - [INFO] Succesfully removed user({user_panel_id}) and servers')
+    user = panel_cache.users.get(str(ctx.author.id))
+    if user:
+        # remove user servers
+        session = running_servers.pop(ctx.author.id, None)
+        if session:
+            await remove_sessions([session])
+        results = await bulk_action('delete_server', [server.id for server in panel_cache.user_servers.get(user.id, ())])
+        for server_id, status in results.items():
+            if status not in (204, 404):
+                log.error(f'Deleting server {server_id} | code: {status}')
+        patch_cache(servers={server_id: None for server_id, status in results.items() if status in (204, 404)})
+
+        # remove user
+        output = await app.delete_user(user.id)
+
+        if 'errors' in output:
+            log.error(f'User {user.id} | {output["errors"][0]["detail"]}')
+        else:
+            patch_cache(users={user.id: None})
+            log.info(f'Succesfully removed user({user.id}) and servers')
 
-            return await message.edit(
-                content='Sorry to see you go... It may take some time for all your data to be removed.'
-            )
-    # remove user from local database
-    output = db_exec('DELETE FROM users WHERE id=?', (ctx.author.id,))
+        return await message.edit(
+            content='Sorry to see you go... It may take some time for all your data to be removed.'
+        )
+    # remove user and their credit history from local database
+    ledger.discard(ctx.author.id)
+    try:
+        await database.transaction(delete_user_rows, ctx.author.id)
+        output = True
+    except Exception as e:
+        log.error(f'Database error | {e}')
+        output = False
+    user_cache.discard(ctx.author.id)
     if output:
         return await message.edit(
             content='Sorry to see you go... It may take some time for all your data to be removed.'
@@ -424,18 +2828,19 @@ async def withdraw(ctx):
 
 @bot.hybrid_command(description='Shows your current credits.')
 async def credits(ctx):
-    return await ctx.send(f'You have `{Person(user_id=ctx.author.id).get_credits()}` credit(s).')
+    person = await Person.get(user_id=ctx.author.id)
+    return await ctx.send(f'You have `{person.get_credits()}` credit(s).')
 
 
 @bot.hybrid_command(description='Daily 60 credits which translate into 1 hour a day.')
 @commands.cooldown(1, 79200, commands.BucketType.user)
 async def daily(ctx):
-    person = Person(user_id=ctx.author.id)
+    person = await Person.get(user_id=ctx.author.id)
     if person.premium:
         amount = 120
     else:
         amount = 60
-    person.update_credits(amount)
+    await person.update_credits(amount, 'daily')
     return await ctx.send(f'You got `{amount}` credit(s).')
 
 
@@ -444,122 +2849,48 @@ async def vote(ctx):
     return await ctx.send('Coming soon.')
 
 
-# 400% cpu | 3GB(3072) ram | 1GB(1024) storage | per server
 @bot.hybrid_command(description='Start or create your server.')
 @commands.check(is_synced)
 @commands.cooldown(2, 60, commands.BucketType.user)
 async def start(ctx):
-    global panel_users, panel_allocations, running_servers
-
     # create user if not exists
-    person = Person(user_id=ctx.author.id)
+    person = await Person.get(user_id=ctx.author.id)
 
     if person.get_credits() < 1:
         return await ctx.send('You don\'t have enough credits.')
 
-    if len(running_servers) == 4:
-        return await ctx.send('The maximum active servers have been reached. Check the queue time with `/queue`.')
-
-    for user in panel_users:
-        if user['attributes']['username'] == str(ctx.author.id):
-            user_panel_id = user['attributes']['id']
-
-            # check if user has server
-            for server in panel_servers:
-                if server['attributes']['user'] == user_panel_id:
-                    # check if server is already unsuspended
-                    if (await app.get_server(server['attributes']['id']))['attributes']['suspended']:
-                        output = await app.unsuspend_server(server['attributes']['id'])
-                        if output.status == 204:
-                            print(f'{current_time()} - [INFO] Starting server {server["attributes"]["id"]}')
-                            running_servers.append(ctx.author.id)
-                            await ctx.send(
-                                'Setting up your server visit https://panel.nextpie.nl to start it. '
-                                '(You get an extra minute to start your server)'
-                            )
-
-                            # start credit deduction loop
-                            output = await credit_reduction(person, server, ctx)
-                            if output.status != 204:
-                                return print(
-                                    f'{current_time()} - [ERROR] Stopping server {server["attributes"]["id"]} | '
-                                    f'code: {output.status}'
-                                )
-                            running_servers.remove(ctx.author.id)
-                            return
-
-                        elif output.status == 500:
-                            return await ctx.send('Something went wrong starting your server, please try again.')
-                        else:
-                            print(
-                                f'{current_time()} - [ERROR] starting server {server["attributes"]["id"]} | '
-                                f'code: {output.status}'
-                            )
-                            return await ctx.send(
-                                'Something unusual went wrong starting your server, please try again.'
-                            )
-                    else:
-                        return await ctx.send(
-                            'Server already active, you may need to manually start it on https://panel.nextpie.nl'
-                        )
-
-            if not person.has_server():
-                # user has no server create one
-                for allocation in panel_allocations:
-                    if not allocation['attributes']['assigned']:
-                        # Paper MC server
-                        server = await app.create_server(
-                            name="DisMine - MC paper",
-                            user_id=user_panel_id,
-                            nest_id=1,
-                            egg_id=2,
-                            docker_image="ghcr.io/pterodactyl/yolks:java_17",
-                            startup="java -Xms128M -XX:MaxRAMPercentage=95.0 -Dterminal.jline=false -Dterminal.ansi=true -jar {{SERVER_JARFILE}}",
-                            environment={
-                                "SERVER_JARFILE": "server.jar",
-                                "MINECRAFT_VERSION": "latest",
-                                "BUILD_NUMBER": "latest",
-                            },
-                            default_allocation=allocation['attributes']['id']
-                        )
-                        await ctx.send(
-                            'Creating your server visit https://panel.nextpie.nl to configure it. '
-                            'You will be prompted to accept the Minecraft EULA.'
-                        )
-
-                        print(f'{current_time()} - [INFO] Starting server {server["attributes"]["id"]}')
-
-                        # set required variables
-                        running_servers.append(ctx.author.id)
-                        person.set_server_status(True)
-
-                        # start credit deduction loop
-                        output = await credit_reduction(person, server, ctx)
-                        if output.status != 204:
-                            return print(
-                                f'{current_time()} - [ERROR] Stopping server {server["attributes"]["id"]} | '
-                                f'code: {output.status}'
-                            )
-                        running_servers.remove(ctx.author.id)
-                        return
-
-                print(f'{current_time()} - [ERROR] No more allocations')
-                return await ctx.send(f'Something went wrong... Go to the support server for help.')
-            else:
-                return await ctx.send(
-                    'Server already active, you may need to manually start it on https://panel.nextpie.nl'
-                )
+    if ctx.author.id in running_servers or ctx.author.id in starting:
+        return await ctx.send(
+            'Server already active, you may need to manually start it on https://panel.nextpie.nl'
+        )
+
+    if ctx.author.id in admission_queue:
+        position, minutes = admission_queue.estimate(ctx.author.id)
+        return await ctx.send(f'You are number `{position}` in the queue, about `{minutes}` minutes to go.')
+
+    # everyone already waiting goes first
+    if admission_queue or not await claim_slot(ctx.author.id):
+        await join_queue(person)
+        position, minutes = admission_queue.estimate(ctx.author.id)
+        return await ctx.send(
+            f'All servers are in use, you are number `{position}` in the queue (about `{minutes}` minutes). '
+            f'I will DM you when your server starts, use `/stop` to leave the queue.'
+        )
 
-    return await ctx.send('Cannot find your account, if you just registered it can take up to 5 minutes to sync.')
+    return await ctx.send(await launch(person))
 
 
 @bot.hybrid_command(description='Stop your running server.')
 @commands.check(is_synced)
 @commands.cooldown(2, 60, commands.BucketType.user)
 async def stop(ctx):
+    if ctx.author.id in admission_queue:
+        await leave_queue([ctx.author.id])
+        update_queue_estimates()
+        return await ctx.send('You left the queue.')
     if ctx.author.id in running_servers:
-        person = Person(user_id=ctx.author.id)
-        person.set_stop_server(True)
+        person = await Person.get(user_id=ctx.author.id)
+        await person.set_stop_server(True)
         return await ctx.send('Stopping your server. When your current credit runs out your server will stop.')
     return await ctx.send('You do not have a server running.')
 
@@ -570,7 +2901,7 @@ async def stop(ctx):
 async def remaining(ctx):
     global running_servers
     if ctx.author.id in running_servers:
-        person = Person(user_id=ctx.author.id)
+        person = await Person.get(user_id=ctx.author.id)
         if person.stop_server():
             time_remaining = 1
         else:
@@ -583,27 +2914,82 @@ async def remaining(ctx):
 @commands.check(is_synced)
 @commands.cooldown(2, 20, commands.BucketType.user)
 async def queue(ctx):
-    global running_servers
+    if ctx.author.id in admission_queue:
+        position, minutes = admission_queue.estimate(ctx.author.id)
+        return await ctx.send(f'You are number `{position}` in the queue, about `{minutes}` minutes to go.')
 
-    if running_servers and len(running_servers) == 4:
-        minimal_credits = 999999999
-        for user in running_servers:
-            person = Person(user)
-            if person.stop_server():
-                user_credits = 0
-            else:
-                user_credits = person.get_credits()
+    if len(running_servers) + len(starting) >= server_slots or admission_queue:
+        position, minutes = admission_queue.estimate()
+        return await ctx.send(
+            f'There are `{position - 1}` people in the queue, the current wait time is `{minutes}` minutes.'
+        )
+    return await ctx.send(f'There is no queue at the moment.')
 
-            if user_credits < minimal_credits:
-                minimal_credits = user_credits + 1
 
-        return await ctx.send(f'The current wait time is `{minimal_credits * 5}` minutes.')
-    else:
-        return await ctx.send(f'There is no queue at the moment.')
+@bot.hybrid_command(description='Grants credits to a list of users, owner only.')
+@commands.is_owner()
+async def grant(
+    ctx, amount: int, dry_run: Optional[bool] = False, file: Optional[discord.Attachment] = None, *, users: str = ''
+):
+    grants, skipped = parse_users(await read_user_list(users, file), amount)
+    if not grants:
+        return await ctx.send('No user ids found.')
+    try:
+        summary = await grant_credits(grants, 'grant', dry_run)
+    except Exception as e:
+        log.error(f'Granting credits to {len(grants)} users | {e}')
+        return await ctx.send('Granting credits failed, nothing was changed.')
+    return await ctx.send(
+        f'{"Would grant" if dry_run else "Granted"} `{summary["credits"]}` credits to `{summary["users"]}` users '
+        f'(`{summary["new"]}` new, `{skipped}` entries skipped) in `{summary["seconds"]:.3f}` seconds.'
+    )
+
+
+@bot.hybrid_command(description='Sets premium for a list of users, owner only.')
+@commands.is_owner()
+async def premium(
+    ctx, status: bool, dry_run: Optional[bool] = False, file: Optional[discord.Attachment] = None, *, users: str = ''
+):
+    user_ids, skipped = parse_users(await read_user_list(users, file))
+    if not user_ids:
+        return await ctx.send('No user ids found.')
+    try:
+        summary = await grant_premium(list(user_ids), status, dry_run)
+    except Exception as e:
+        log.error(f'Setting premium for {len(user_ids)} users | {e}')
+        return await ctx.send('Setting premium failed, nothing was changed.')
+    return await ctx.send(
+        f'{"Would set" if dry_run else "Set"} premium to `{status}` for `{summary["users"]}` users '
+        f'(`{summary["new"]}` new, `{skipped}` entries skipped) in `{summary["seconds"]:.3f}` seconds.'
+    )
+
+
+@bot.hybrid_command(description='Profiles the bot for a number of seconds, owner only.')
+@commands.is_owner()
+async def profile(ctx, seconds: int = 10):
+    seconds = max(1, min(seconds, 60))
+    message = await ctx.send(f'Profiling for `{seconds}` seconds...')
+    before = asyncio.all_tasks()
+    own, total, samples = await asyncio.to_thread(
+        sample_stacks, threading.get_ident(), seconds, float(getenv('profile_interval', 0.005))
+    )
+    tasks = [task_summary(task) for task in asyncio.all_tasks() & before if not task.done()]
+    report = profile_report(own, total, max(samples, 1), seconds, tasks)
+    await message.delete()
+    return await ctx.send(file=discord.File(io.BytesIO(report.encode()), 'profile.txt'))
+
+
+mark_phase('module')
 
+if __name__ == '__main__':
+    # # Setup .env
+    if not path.exists('.env'):
+        with open('.env', 'w') as environment:
+            environment.write('bot_token=yourToken\npterodactyl_site=https://example.com\napi_key=yourApiKey')
+        quit(f'please configure the .env file')
 
-# Pterodactyl requirement
-print('started')
+    # Pterodactyl requirement
+    print('started')
 
-# run bot
-bot.run(token=getenv('bot_token'), log_level=0)
+    # run bot
+    bot.run(token=getenv('bot_token'), log_level=0)
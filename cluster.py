@@ -0,0 +1,97 @@
+import asyncio
+import aiohttp
+import signal
+import sys
+from datetime import datetime
+from dotenv import load_dotenv
+from os import cpu_count, environ, getenv, path
+
+load_dotenv()
+
+# # cluster setup
+# every worker runs bot.py for a range of shards, they share state through the database file
+bot_file = f'{path.dirname(path.abspath(__file__))}/bot.py'
+workers = {}
+stopping = False
+
+
+# # functions
+def current_time():
+    return datetime.now().strftime('%d/%m/%Y %H:%M:%S')
+
+
+async def recommended_shards():
+    async with aiohttp.ClientSession() as session:
+        async with session.get(
+            'https://discord.com/api/v10/gateway/bot', headers={'Authorization': f'Bot {getenv("bot_token")}'}
+        ) as response:
+            response.raise_for_status()
+            return (await response.json())['shards']
+
+
+def shard_ranges(shard_count: int, worker_count: int):
+    # contiguous ranges, the first workers take one extra shard when it doesn't divide evenly
+    size, extra = divmod(shard_count, worker_count)
+    start = 0
+    for cluster_id in range(worker_count):
+        end = start + size + (cluster_id < extra)
+        yield list(range(start, end))
+        start = end
+
+
+async def run_worker(cluster_id: int, shard_ids: list, shard_count: int):
+    # restarts the worker when it exits on its own, waiting longer after every quick crash
+    delay = 1
+    while not stopping:
+        environment = {
+            **environ,
+            'cluster_id': str(cluster_id),
+            'shard_ids': ','.join(map(str, shard_ids)),
+            'shard_count': str(shard_count)
+        }
+        # every worker serves its metrics on its own port, counting up from metrics_port
+        port = int(getenv('metrics_port', 9464))
+        if port:
+            environment['metrics_port'] = str(port + cluster_id)
+        started = asyncio.get_running_loop().time()
+        # own session so a ctrl+c in the terminal only reaches the launcher, which forwards it once
+        workers[cluster_id] = await asyncio.create_subprocess_exec(
+            sys.executable, bot_file, env=environment, start_new_session=True
+        )
+        print(f'{current_time()} - [INFO] Started cluster {cluster_id} with shards {shard_ids}')
+        code = await workers[cluster_id].wait()
+        if stopping:
+            break
+        if asyncio.get_running_loop().time() - started > 60:
+            delay = 1
+        print(f'{current_time()} - [ERROR] Cluster {cluster_id} exited with code {code}, restarting in {delay}s')
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 60)
+
+
+def stop():
+    global stopping
+    stopping = True
+    # SIGINT makes bot.run close the bot, which flushes the ledger, activity and queued messages, SIGTERM would not
+    for worker in workers.values():
+        if worker.returncode is None:
+            worker.send_signal(signal.SIGINT)
+
+
+async def main():
+    shard_count = int(getenv('shard_count', 0)) or await recommended_shards()
+    worker_count = min(int(getenv('cluster_workers', 0)) or cpu_count() or 1, shard_count)
+    print(f'{current_time()} - [INFO] Running {shard_count} shards on {worker_count} clusters')
+
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(signal_number, stop)
+    await asyncio.gather(
+        *(run_worker(cluster_id, shard_ids, shard_count)
+          for cluster_id, shard_ids in enumerate(shard_ranges(shard_count, worker_count)))
+    )
+
+
+if __name__ == '__main__':
+    if not path.exists('.env'):
+        quit(f'please configure the .env file, run bot.py once to create it')
+    asyncio.run(main())